@@ -3,46 +3,118 @@ import json
 from pathlib import Path
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, simpledialog
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import re
 import shutil
 import csv
-
-# Для экспорта в PDF
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4, landscape
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-
-# Для экспорта в Excel
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill
-
-# Для графика
-import matplotlib.pyplot as plt
+import sqlite3
+import hashlib
+import marshal
+import gc
+import sys
+import uuid
+import time
+import threading
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import bisect
+from array import array
+from decimal import Decimal, DecimalException, ROUND_HALF_UP
+from operator import attrgetter
+
+# Итоги и группировки по колонкам. reportlab (PDF), openpyxl (Excel) и matplotlib (графики)
+# импортируются при первом использовании: большинству сеансов они не нужны, а загружаются долго
 import numpy as np
 
 # Путь к шрифту и иконке
 ASSETS_DIR = Path(__file__).parent / "assets"
 CHAKRA_FONT_PATH = ASSETS_DIR / "ChakraPetch-Regular.ttf"
 ICON_PATH = Path(__file__).parent / "ico.ico"
-USE_CHAKRA_FONT = CHAKRA_FONT_PATH.exists()
-
-if USE_CHAKRA_FONT:
-    try:
-        pdfmetrics.registerFont(TTFont('ChakraPetch', str(CHAKRA_FONT_PATH)))
-    except Exception as e:
-        messagebox.showwarning("Шрифт", f"Не удалось загрузить шрифт ChakraPetch:\n{e}")
-        USE_CHAKRA_FONT = False
 
 # Файлы настроек и данных
 SETTINGS_PATH = Path(__file__).parent / "settings.json"
 AUDIT_LOG_PATH = None  # будет задан после загрузки base_dir
 
+# Суффикс временных файлов надёжной записи и файлы папки базы, записываемые через них.
+# Временные файлы других экземпляров моложе TEMP_STALE_SECONDS считаются ещё записываемыми
+TEMP_SUFFIX = ".tmp"
+TEMP_STALE_SECONDS = 600
+RECOVERABLE_FILES = ["base.json", "base.journal", "base.cache", "solutor.json", "last_backup.txt"]
+
+# Версия формата base.cache (предразобранный и отсортированный снимок базы)
+CACHE_VERSION = 6
+
+# Наибольшая по модулю корректная сумма в копейках (10 трлн руб.): суммы хранятся в int64,
+# и запас нужен, чтобы итоги по всем записям тоже помещались в int64
+MAX_AMOUNT_KOPECKS = 10 ** 15
+
+# Журнал изменений base.json сворачивается в снимок по достижении любого из порогов
+JOURNAL_MAX_ENTRIES = 500
+JOURNAL_MAX_BYTES = 1024 * 1024
+
+# Длительность одной порции построения индекса поиска в цикле событий Tk
+SEARCH_INDEX_SLICE_SECONDS = 0.02
+
+# Задержка перед применением фильтров при наборе строки поиска и предел сужения
+# предыдущего результата (для большего числа строк быстрее индекс поиска)
+FILTER_DEBOUNCE_MS = 150
+NARROWING_MAX_ROWS = 20_000
+
+# С какого числа строк таблица показывается виртуально и сколько строк держит окно не больше
+VIRTUAL_TABLE_MIN_ROWS = 1000
+VIRTUAL_WINDOW_ROWS = 100
+
+# Длительность одной порции заполнения таблицы в цикле событий Tk
+TABLE_FILL_SLICE_SECONDS = 0.02
+
+# Как часто проверять, не изменили ли базу другие экземпляры программы
+EXTERNAL_CHECK_MS = 5000
+
+# Сколько строк реестра в одной таблице PDF (таблицы создаются по мере вёрстки страниц)
+PDF_CHUNK_ROWS = 100
+PDF_FONT_SIZE = 7
+
+# Предельная ширина колонки в Excel (в символах)
+EXCEL_MAX_COLUMN_WIDTH = 40
+
+# Фоновые выгрузки: как часто сообщать о прогрессе (в строках) и опрашивать очередь событий
+EXPORT_PROGRESS_ROWS = 500
+EXPORT_POLL_MS = 100
+
+# Пакетные отчёты: способы деления реестра и имя файла со списком созданных отчётов
+BATCH_PARTITIONS = [
+    ("payer_year", "По плательщикам и годам"),
+    ("payer", "По плательщикам"),
+    ("year", "По годам"),
+]
+BATCH_MANIFEST_NAME = "manifest.json"
+
+# Загружать ли библиотеки экспорта и графиков в фоне после открытия окна и через сколько
+PREWARM_BACKENDS = True
+PREWARM_DELAY_MS = 1000
+
+# Колонки реестра и соответствующие им поля таблицы SQLite
+COLUMNS = ["Дата", "Заказ", "Сумма", "Поставщик", "Плательщик", "Инициатор", "Обоснование", "Оплата", "Забрал", "Комментарии"]
+COLUMN_INDEX = {col: i for i, col in enumerate(COLUMNS)}
+# Колонки с часто повторяющимися значениями: строки интернируются и хранятся в одном экземпляре
+INTERNED_COLUMNS = {"Дата", "Поставщик", "Плательщик", "Инициатор", "Оплата", "Забрал"}
+SQLITE_FIELDS = {
+    "Дата": "date",
+    "Заказ": "order_no",
+    "Сумма": "amount",
+    "Поставщик": "supplier",
+    "Плательщик": "payer",
+    "Инициатор": "initiator",
+    "Обоснование": "reason",
+    "Оплата": "paid",
+    "Забрал": "picked_up",
+    "Комментарии": "comments",
+}
+
 
 def load_base_dir():
+    recover_temp_files(SETTINGS_PATH.parent, [SETTINGS_PATH.name])
     if SETTINGS_PATH.exists():
         try:
             with open(SETTINGS_PATH, 'r', encoding='utf-8') as f:
@@ -72,23 +144,96 @@ def load_base_dir():
 
 
 def save_base_dir(base_dir: Path):
-    with open(SETTINGS_PATH, 'w', encoding='utf-8') as f:
-        json.dump({"base_dir": str(base_dir)}, f, ensure_ascii=False, indent=4)
+    atomic_write_json(SETTINGS_PATH, {"base_dir": str(base_dir)})
 
 
 def ensure_base_exists(base_path: Path):
     base_path.parent.mkdir(parents=True, exist_ok=True)
     if not base_path.exists():
-        with open(base_path, 'w', encoding='utf-8') as f:
-            json.dump([], f, ensure_ascii=False, indent=4)
+        atomic_write_json(base_path, [])
 
 
 def ensure_solutor_exists(solutor_path: Path):
     solutor_path.parent.mkdir(parents=True, exist_ok=True)
     if not solutor_path.exists():
         default_payers = ["ИТ", "Бухгалтерия", "Отдел закупок", "Дирекция"]
-        with open(solutor_path, 'w', encoding='utf-8') as f:
-            json.dump(default_payers, f, ensure_ascii=False, indent=4)
+        atomic_write_json(solutor_path, default_payers)
+
+
+def temp_path_for(path: Path) -> Path:
+    """Уникальный временный файл рядом с целевым: папку базы могут одновременно писать несколько экземпляров."""
+    return path.with_name(f"{path.name}.{os.getpid()}-{uuid.uuid4().hex[:8]}{TEMP_SUFFIX}")
+
+
+def atomic_write(path: Path, data: bytes):
+    """Надёжная запись: временный файл рядом с целевым, fsync и атомарная замена."""
+    temp_path = temp_path_for(path)
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            temp_path.unlink()
+        except OSError:
+            pass
+        raise
+    fsync_dir(path.parent)
+
+
+def atomic_write_json(path: Path, obj):
+    atomic_write(path, json.dumps(obj, ensure_ascii=False, indent=4).encode('utf-8'))
+
+
+def fsync_dir(directory: Path):
+    """Фиксирует на диске переименование в папке (на Windows не поддерживается)."""
+    try:
+        fd = os.open(str(directory), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def recover_temp_files(directory: Path, names):
+    """Разбирает временные файлы, оставшиеся после сбоя во время записи.
+
+    Трогаются только файлы старше TEMP_STALE_SECONDS (более новые может писать другой экземпляр).
+    Если целевой файл цел, временные удаляются. Если целевого файла нет, на его место ставится
+    самый новый из временных (для .json — только если он читается)."""
+    now = time.time()
+    for name in names:
+        target = directory / name
+        stale = []
+        for temp_path in list(directory.glob(f"{name}.*{TEMP_SUFFIX}")) + [directory / (name + TEMP_SUFFIX)]:
+            try:
+                mtime = temp_path.stat().st_mtime
+            except OSError:
+                continue
+            if now - mtime >= TEMP_STALE_SECONDS:
+                stale.append((mtime, temp_path))
+        stale.sort(reverse=True)
+        for _, temp_path in stale:
+            try:
+                if not target.exists():
+                    if target.suffix == ".json":
+                        with open(temp_path, 'r', encoding='utf-8') as f:
+                            json.load(f)
+                    os.replace(temp_path, target)
+                    log_action(f"Восстановлен файл {name} после сбоя записи")
+                else:
+                    temp_path.unlink()
+            except (OSError, ValueError):
+                try:
+                    temp_path.unlink()
+                except OSError:
+                    pass
 
 
 def log_action(action: str):
@@ -103,24 +248,1051 @@ def log_action(action: str):
         pass  # Не критично, если лог не пишется
 
 
-def validate_date(date_str: str) -> bool:
-    if not re.fullmatch(r'\d{2}\.\d{2}\.\d{4}', date_str):
-        return False
+DATE_RE = re.compile(r'\d{2}\.\d{2}\.\d{4}')
+
+
+def parse_date(date_str) -> tuple:
+    """Разбирает дату ДД.ММ.ГГГГ в (порядковый номер дня, год, месяц); (0, 0, 0) — дата некорректна."""
+    if not isinstance(date_str, str):
+        return 0, 0, 0
+    parsed = _parsed_dates.get(date_str)
+    if parsed is not None:
+        return parsed
+    stripped = date_str.strip()
+    parsed = (0, 0, 0)
+    if DATE_RE.fullmatch(stripped):
+        year, month = int(stripped[6:]), int(stripped[3:5])
+        try:
+            parsed = (date(year, month, int(stripped[:2])).toordinal(), year, month)
+        except ValueError:
+            pass
+    if len(_parsed_dates) < 100_000:
+        _parsed_dates[date_str] = parsed  # одинаковые даты разделяют одни и те же объекты int
+    return parsed
+
+
+_parsed_dates = {}
+
+
+def parse_amount(amount_str) -> tuple:
+    """Разбирает сумму вида "1 234,56" в (копейки, признак корректности).
+
+    Разбор точный (Decimal), доли копейки округляются до ближайшей копейки, половина — от нуля.
+    Суммы больше MAX_AMOUNT_KOPECKS по модулю некорректны (иначе не поместятся в колонки int64)."""
+    if not isinstance(amount_str, str) or not amount_str.strip():
+        return 0, False
     try:
-        datetime.strptime(date_str, "%d.%m.%Y")
-        return True
-    except ValueError:
-        return False
+        value = Decimal(amount_str.replace(" ", "").replace("\xa0", "").replace(",", "."))
+        if not value.is_finite():
+            return 0, False
+        kopecks = int((value * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except DecimalException:
+        return 0, False
+    if abs(kopecks) > MAX_AMOUNT_KOPECKS:
+        return 0, False
+    return kopecks, True
+
+
+def format_money(kopecks: int, with_kopecks: bool = True) -> str:
+    """Сумма в копейках как "1 234 567,89"; with_kopecks=False — в целых рублях с округлением."""
+    if with_kopecks:
+        rubles, rest = divmod(abs(kopecks), 100)
+    else:
+        rubles, rest = (abs(kopecks) + 50) // 100, 0
+    text = f"{rubles:,}".replace(",", " ")
+    if with_kopecks:
+        text += f",{rest:02d}"
+    if kopecks < 0 and (rubles or rest):
+        text = "-" + text
+    return text
+
+
+_chakra_font_lock = threading.Lock()
+_chakra_font_registered = None  # None — регистрация ещё не выполнялась
+_chakra_font_error = None  # ошибка регистрации, ещё не показанная пользователю
+
+
+def register_chakra_font() -> bool:
+    """Регистрирует шрифт ChakraPetch в reportlab при первом вызове. Возвращает, доступен ли шрифт."""
+    global _chakra_font_registered, _chakra_font_error
+    with _chakra_font_lock:
+        if _chakra_font_registered is None:
+            _chakra_font_registered = False
+            if CHAKRA_FONT_PATH.exists():
+                try:
+                    from reportlab.pdfbase import pdfmetrics
+                    from reportlab.pdfbase.ttfonts import TTFont
+                    pdfmetrics.registerFont(TTFont('ChakraPetch', str(CHAKRA_FONT_PATH)))
+                    _chakra_font_registered = True
+                except Exception as e:
+                    _chakra_font_error = e
+        return _chakra_font_registered
+
+
+def take_chakra_font_error():
+    """Ошибка регистрации шрифта, если она была и ещё не показана (показывается один раз)."""
+    global _chakra_font_error
+    with _chakra_font_lock:
+        error, _chakra_font_error = _chakra_font_error, None
+        return error
+
+
+def prewarm_backends():
+    """Заранее загружает библиотеки экспорта и графиков и регистрирует шрифт (вызывается в фоновом потоке)."""
+    try:
+        import reportlab.platypus  # noqa: F401
+        import openpyxl  # noqa: F401
+        import matplotlib.figure  # noqa: F401
+        import matplotlib.backends.backend_tkagg  # noqa: F401
+        register_chakra_font()
+    except Exception:
+        pass  # при ошибке библиотека загрузится (и сообщит об ошибке) при первом использовании
+
+
+def format_total_line(total: int, invalid_amounts: int = 0) -> str:
+    """Строка "Итого" для выгрузок: total в копейках."""
+    line = f"Итого: {format_money(total)} руб."
+    if invalid_amounts:
+        line += f" (записей с некорректной суммой, не вошедших в итог: {invalid_amounts})"
+    return line
+
+
+def validate_date(date_str: str) -> bool:
+    return parse_date(date_str)[0] > 0
 
 
 def validate_amount(amount_str: str) -> bool:
-    if not amount_str.strip():
-        return False
+    return parse_amount(amount_str)[1]
+
+
+class Record:
+    """Запись реестра в компактном виде.
+
+    id — постоянный уникальный идентификатор (поле "id" в base.json, iid строки таблицы),
+    values — кортеж значений колонок в порядке COLUMNS (повторяющиеся строки интернированы),
+    date_ord — порядковый номер дня (0, если дата некорректна), amount — сумма в копейках.
+    Для чтения полей поддерживается интерфейс словаря: record.get(col), record[col]."""
+    __slots__ = ("id", "values", "date_ord", "year", "month", "amount", "amount_valid")
+
+    def __init__(self, data=()):
+        data = dict(data)
+        self.id = str(data.get("id") or new_record_id())
+        values = []
+        for col in COLUMNS:
+            value = data.get(col, "")
+            value = "" if value is None else str(value)
+            values.append(sys.intern(value) if col in INTERNED_COLUMNS else value)
+        self.values = tuple(values)
+        self.date_ord, self.year, self.month = parse_date(self.values[COLUMN_INDEX["Дата"]])
+        self.amount, self.amount_valid = parse_amount(self.values[COLUMN_INDEX["Сумма"]])
+
+    @classmethod
+    def from_parsed_rows(cls, rows) -> list:
+        """Собирает записи из строк (id, values, date_ord, year, month, amount, amount_valid) без повторного разбора."""
+        new = cls.__new__
+        records = []
+        for record_id, values, date_ord, year, month, amount, amount_valid in rows:
+            record = new(cls)
+            record.id = record_id
+            record.values = values
+            record.date_ord, record.year, record.month = date_ord, year, month
+            record.amount, record.amount_valid = amount, amount_valid
+            records.append(record)
+        return records
+
+    def parsed_row(self) -> tuple:
+        return self.id, self.values, self.date_ord, self.year, self.month, self.amount, self.amount_valid
+
+    def get(self, col, default=None):
+        index = COLUMN_INDEX.get(col)
+        return default if index is None else self.values[index]
+
+    def __getitem__(self, col):
+        return self.values[COLUMN_INDEX[col]]
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self.values == other.values
+        return NotImplemented
+
+    __hash__ = None
+
+    def to_dict(self) -> dict:
+        data = {"id": self.id}
+        data.update(zip(COLUMNS, self.values))
+        return data
+
+
+def sort_key(record, col):
+    """Типизированный ключ сортировки по колонке: даты и числа сравниваются как числа, прочее —
+    как строки без учёта регистра; некорректные даты и суммы идут после корректных."""
+    if col == "Дата":
+        return (0, record.date_ord) if record.date_ord else (2, "")
+    if col == "Сумма":
+        return (0, record.amount) if record.amount_valid else (2, record.get(col, "").lower())
+    value = record.get(col, "")
     try:
-        float(amount_str.replace(" ", "").replace(",", "."))
-        return True
+        return (0, float(value.replace(" ", "").replace(",", ".")))
     except ValueError:
-        return False
+        return (1, value.lower())
+
+
+def new_record_id() -> str:
+    return uuid.uuid4().hex
+
+
+class SearchIndex:
+    """Инвертированный индекс для поиска подстроки по значениям колонок.
+
+    Каждое различное значение колонок получает номер; для триграммы (в нижнем регистре) хранится
+    компактный массив номеров значений, для значения — номер документа или массив номеров.
+    Строки не копируются: в индексе те же объекты, что в записях. Триграммы строки поиска дают
+    значения-кандидаты, вхождение подстроки проверяется по ним (а не по каждой записи), и результат —
+    точное множество id подходящих записей. Когда индекс не быстрее просмотра записей (строка короче
+    триграммы, слишком частая триграмма, совпадает большинство записей), search возвращает None."""
+    GRAM = 3
+    # Триграмма, встречающаяся в большей доле значений, не сужает поиск
+    COMMON_GRAM_SHARE = 0.25
+
+    def __init__(self):
+        self.value_ids = {}  # значение -> номер значения
+        self.values = []  # номер значения -> значение (тот же объект строки, что в записи)
+        self.value_docs = []  # номер значения -> номер документа или array('q') номеров документов
+        self.gram_values = {}  # триграмма -> array('q') номеров значений
+        self.doc_ids = []  # номер документа -> id записи (None — документ устарел)
+        self.doc_of = {}  # id записи -> номер документа
+        self.dead = 0
+        self.ready = False
+
+    def add(self, record):
+        if record.id in self.doc_of:
+            self.remove(record.id)
+        doc = len(self.doc_ids)
+        self.doc_ids.append(record.id)
+        self.doc_of[record.id] = doc
+        value_ids = self.value_ids
+        value_docs = self.value_docs
+        for value in set(record.values):
+            if not value:
+                continue
+            value_id = value_ids.get(value)
+            if value_id is None:
+                value_id = len(self.values)
+                value_ids[value] = value_id
+                self.values.append(value)
+                value_docs.append(doc)
+                self._add_value_grams(value_id, value.lower())
+            else:
+                docs = value_docs[value_id]
+                if isinstance(docs, int):
+                    value_docs[value_id] = array('q', (docs, doc))
+                else:
+                    docs.append(doc)
+
+    def _add_value_grams(self, value_id: int, value: str):
+        gram_values = self.gram_values
+        for gram in {value[i:i + self.GRAM] for i in range(len(value) - self.GRAM + 1)}:
+            value_ids = gram_values.get(gram)
+            if value_ids is None:
+                gram_values[gram] = array('q', (value_id,))
+            else:
+                value_ids.append(value_id)
+
+    def remove(self, record_id):
+        doc = self.doc_of.pop(record_id, None)
+        if doc is not None:
+            self.doc_ids[doc] = None
+            self.dead += 1
+
+    def needs_rebuild(self) -> bool:
+        """Устаревших документов больше половины — индекс стоит построить заново."""
+        return self.dead > 1000 and self.dead * 2 > len(self.doc_ids)
+
+    def matching_values(self, term: str):
+        """Номера значений, содержащих term; None — индекс не сузит поиск."""
+        values = self.values
+        if len(term) < self.GRAM:
+            return None
+        smallest = None
+        for gram in {term[i:i + self.GRAM] for i in range(len(term) - self.GRAM + 1)}:
+            value_ids = self.gram_values.get(gram)
+            if value_ids is None:
+                return []
+            if smallest is None or len(value_ids) < len(smallest):
+                smallest = value_ids
+        if len(smallest) > self.COMMON_GRAM_SHARE * len(values):
+            return None
+        return [value_id for value_id in smallest if term in values[value_id].lower()]
+
+    def search(self, term: str):
+        """Множество id записей, в значениях колонок которых есть подстрока term (в нижнем регистре).
+
+        None — индекс ещё не построен или просмотр записей будет быстрее."""
+        if not self.ready:
+            return None
+        value_ids = self.matching_values(term)
+        if value_ids is None:
+            return None
+        value_docs = self.value_docs
+        matched = [value_docs[value_id] for value_id in value_ids]
+        # Подходит большинство записей: просмотр с ранним выходом дешевле сбора множества id
+        if sum(1 if isinstance(docs, int) else len(docs) for docs in matched) * 2 > len(self.doc_of):
+            return None
+        docs = set()
+        for doc_numbers in matched:
+            if isinstance(doc_numbers, int):
+                docs.add(doc_numbers)
+            else:
+                docs.update(doc_numbers)
+        doc_ids = self.doc_ids
+        return {doc_ids[doc] for doc in docs if doc_ids[doc] is not None}
+
+
+class DateIndex:
+    """Порядковые номера дат записей по возрастанию и выровненный с ними список id.
+
+    Выборка за период — два bisect и срез; записи с некорректной датой в индекс не входят."""
+
+    def __init__(self, records=()):
+        pairs = sorted((record.date_ord, record.id) for record in records if record.date_ord)
+        self.ords = array('l', [date_ord for date_ord, _ in pairs])
+        self.ids = [record_id for _, record_id in pairs]
+        self.date_of = dict(zip(self.ids, self.ords))  # id записи -> порядковый номер даты
+
+    def add(self, record):
+        if record.id in self.date_of:
+            self.remove(record.id)
+        if not record.date_ord:
+            return
+        i = bisect.bisect_right(self.ords, record.date_ord)
+        self.ords.insert(i, record.date_ord)
+        self.ids.insert(i, record.id)
+        self.date_of[record.id] = record.date_ord
+
+    def remove(self, record_id):
+        date_ord = self.date_of.pop(record_id, None)
+        if date_ord is None:
+            return
+        lo = bisect.bisect_left(self.ords, date_ord)
+        hi = bisect.bisect_right(self.ords, date_ord, lo)
+        i = self.ids.index(record_id, lo, hi)
+        del self.ords[i]
+        del self.ids[i]
+
+    def range(self, from_ord=None, to_ord=None) -> list:
+        """id записей с датой в периоде [from_ord, to_ord]; None — граница не задана."""
+        lo = 0 if from_ord is None else bisect.bisect_left(self.ords, from_ord)
+        hi = len(self.ords) if to_ord is None else bisect.bisect_right(self.ords, to_ord, lo)
+        return self.ids[lo:hi]
+
+
+class ColumnStore:
+    """Колоночное представление all_data для аналитики: массивы NumPy, выровненные с позициями записей.
+
+    date_ord, year, month, amount (копейки), amount_valid и коды плательщика и поставщика (индексы
+    в payers и suppliers). Общий итог, итоги по годам и число записей с некорректной суммой
+    поддерживаются при каждом изменении записи."""
+    FIELDS = ("date_ord", "year", "month", "amount", "amount_valid", "payer", "supplier")
+    DTYPES = (np.int32, np.int32, np.int32, np.int64, np.bool_, np.int32, np.int32)
+
+    def __init__(self, records=()):
+        records = records if isinstance(records, list) else list(records)
+        self.payers, self.payer_codes = [], {}
+        self.suppliers, self.supplier_codes = [], {}
+        n = len(records)
+        for field, dtype in zip(self.FIELDS[:5], self.DTYPES[:5]):
+            setattr(self, field, np.fromiter(map(attrgetter(field), records), dtype, n))
+        for field, col, codes, names in (("payer", "Плательщик", self.payer_codes, self.payers),
+                                         ("supplier", "Поставщик", self.supplier_codes, self.suppliers)):
+            # Значения интернированы: строка кодируется один раз, дальше — поиск в словаре по значению
+            raw_codes = {}
+            index = COLUMN_INDEX[col]
+            column = []
+            for record in records:
+                value = record.values[index]
+                code = raw_codes.get(value)
+                if code is None:
+                    code = raw_codes[value] = self._code(codes, names, value)
+                column.append(code)
+            setattr(self, field, np.array(column, dtype=np.int32))
+        self.total = int(self.amount.sum())
+        self.invalid_amounts = n - int(np.count_nonzero(self.amount_valid))
+        sums = np.zeros(int(self.year.max()) + 1 if n else 0, np.int64)
+        np.add.at(sums, self.year, self.amount)
+        counts = np.bincount(self.year, minlength=len(sums))
+        self.by_year = {int(year): int(sums[year]) for year in np.nonzero(counts)[0]}
+
+    @staticmethod
+    def _code(codes: dict, names: list, value: str) -> int:
+        value = value.strip()
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(names)
+            names.append(value)
+        return code
+
+    def _row(self, record) -> tuple:
+        return (record.date_ord, record.year, record.month, record.amount, record.amount_valid,
+                self._code(self.payer_codes, self.payers, record["Плательщик"]),
+                self._code(self.supplier_codes, self.suppliers, record["Поставщик"]))
+
+    def _count(self, year: int, amount: int, amount_valid: bool, sign: int):
+        self.total += sign * amount
+        self.by_year[year] = self.by_year.get(year, 0) + sign * amount
+        if not amount_valid:
+            self.invalid_amounts += sign
+
+    def _count_position(self, position: int, sign: int):
+        self._count(int(self.year[position]), int(self.amount[position]), bool(self.amount_valid[position]), sign)
+
+    def insert(self, position: int, record):
+        for field, value in zip(self.FIELDS, self._row(record)):
+            setattr(self, field, np.insert(getattr(self, field), position, value))
+        self._count_position(position, 1)
+
+    def delete(self, position: int):
+        self._count_position(position, -1)
+        for field in self.FIELDS:
+            setattr(self, field, np.delete(getattr(self, field), position))
+
+    def update(self, position: int, record):
+        self._count_position(position, -1)
+        for field, value in zip(self.FIELDS, self._row(record)):
+            getattr(self, field)[position] = value
+        self._count_position(position, 1)
+
+    def names(self, dim: str):
+        """Строки, соответствующие кодам измерения (None — измерение числовое)."""
+        return {"payer": self.payers, "supplier": self.suppliers}.get(dim)
+
+
+class AggregateCube:
+    """Итоги реестра по измерениям год, месяц, плательщик, поставщик над массивами ColumnStore.
+
+    Куб всей базы (positions=None) берёт общий итог и итоги по годам у ColumnStore, которые
+    поддерживаются при изменениях; куб отобранных записей считается векторно по их позициям.
+    Записи с некорректной датой относятся к году и месяцу 0."""
+    DIMENSIONS = ("year", "month", "payer", "supplier")
+
+    def __init__(self, store, positions=None):
+        self.store = store
+        self.positions = positions  # массив позиций записей в all_data или None — все записи
+
+    def _column(self, field: str):
+        column = getattr(self.store, field)
+        return column if self.positions is None else column[self.positions]
+
+    @property
+    def total(self) -> int:
+        if self.positions is None:
+            return self.store.total
+        return int(self._column("amount").sum())
+
+    @property
+    def invalid_amounts(self) -> int:
+        """Число записей с некорректной суммой (в итоги они входят нулём)."""
+        if self.positions is None:
+            return self.store.invalid_amounts
+        return int(np.count_nonzero(~self._column("amount_valid")))
+
+    @property
+    def by_year(self) -> dict:
+        if self.positions is None:
+            return self.store.by_year
+        return self.group("year")
+
+    def group(self, *dims, **where) -> dict:
+        """Суммы в копейках по измерениям dims среди записей, подходящих под where.
+
+        Условие — значение измерения или пара (от, до) включительно, например
+        group("month", year=2025) или group("payer", year=(2020, 2024)). Ключ результата —
+        значение измерения или кортеж значений, если измерений несколько."""
+        amount = self._column("amount")
+        mask = None
+        for dim, value in where.items():
+            column = self._column(dim)
+            names = self.store.names(dim)
+            if names is not None:
+                value = (self.store.payer_codes if dim == "payer" else self.store.supplier_codes).get(value.strip())
+                if value is None:
+                    return {}
+            if isinstance(value, tuple):
+                condition = (column >= value[0]) & (column <= value[1])
+            else:
+                condition = column == value
+            mask = condition if mask is None else mask & condition
+        columns = [self._column(dim) for dim in dims]
+        if mask is not None:
+            amount = amount[mask]
+            columns = [column[mask] for column in columns]
+        if not len(amount):
+            return {}
+
+        # Ячейка — составной код: значения измерений как разряды с основанием (max - min + 1)
+        key = np.zeros(len(amount), np.int64)
+        lows, sizes = [], []
+        for column in columns:
+            low = int(column.min())
+            size = int(column.max()) - low + 1
+            key = key * size + (column - low)
+            lows.append(low)
+            sizes.append(size)
+        span = 1
+        for size in sizes:
+            span *= size
+        if span <= max(4 * len(key), 1 << 16):
+            cells = np.nonzero(np.bincount(key, minlength=span))[0]
+            sums = np.zeros(span, np.int64)
+            np.add.at(sums, key, amount)
+            sums = sums[cells]
+        else:
+            cells, inverse = np.unique(key, return_inverse=True)
+            sums = np.zeros(len(cells), np.int64)
+            np.add.at(sums, inverse, amount)
+
+        parts = []
+        rest = cells
+        for low, size in zip(reversed(lows), reversed(sizes)):
+            parts.append((rest % size + low).tolist())
+            rest = rest // size
+        parts.reverse()
+        for i, dim in enumerate(dims):
+            names = self.store.names(dim)
+            if names is not None:
+                parts[i] = [names[code] for code in parts[i]]
+        keys = parts[0] if len(dims) == 1 else zip(*parts)
+        return dict(zip(keys, sums.tolist()))
+
+
+def replay_journal(records: list, entries) -> list:
+    """Применяет записи журнала (insert/update/delete) к снимку базы по id записей."""
+    positions = {record.get("id"): i for i, record in enumerate(records)}
+    for entry in entries:
+        op = entry.get("op")
+        if op == "insert":
+            for record in entry.get("records", []):
+                positions[record.get("id")] = len(records)
+                records.append(record)
+        elif op == "update":
+            record = entry.get("record", {})
+            i = positions.get(record.get("id"))
+            if i is not None:
+                records[i] = record
+        elif op == "delete":
+            i = positions.pop(entry.get("id"), None)
+            if i is not None:
+                records[i] = None
+    return [record for record in records if record is not None]
+
+
+class JsonStorage:
+    """Хранение реестра в base.json: изменения дописываются в журнал base.journal,
+    который периодически сворачивается в новый снимок base.json."""
+    name = "json"
+
+    def __init__(self, base_dir: Path, readonly_mode: bool):
+        self.path = base_dir / "base.json"
+        self.journal_path = base_dir / "base.journal"
+        self.cache_path = base_dir / "base.cache"
+        self.readonly_mode = readonly_mode
+        self.lock = threading.Lock()
+        self.snapshot_digest = None  # хэш base.json, к которому относится журнал
+        self.journal_digest = None
+        self.journal_entries = 0
+        self.compaction_thread = None
+        self.cache_thread = None
+        self.from_cache = False  # последняя загрузка взята из base.cache (уже отсортирована)
+        self.cache_behind = False  # к данным кэша пришлось применить хвост журнала — кэш стоит обновить
+        self.loaded_files = None  # подписи base.json и base.journal на момент загрузки
+        self.known_files = None  # подписи после последней загрузки или записи этим экземпляром
+        self.external_change = False  # файлы базы менял кто-то другой после загрузки
+
+    def ensure_exists(self):
+        ensure_base_exists(self.path)
+
+    @staticmethod
+    def _digest(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def _read_journal(self) -> list:
+        """Читает записи журнала, если он относится к текущему снимку base.json."""
+        self.journal_digest = None
+        if not self.journal_path.exists():
+            return []
+        raw = self.journal_path.read_bytes()
+        self.journal_digest = self._digest(raw)
+        lines = raw.decode('utf-8').splitlines()
+        try:
+            if not lines or json.loads(lines[0]).get("snapshot") != self.snapshot_digest:
+                return []  # журнал уже свёрнут в снимок
+        except (ValueError, AttributeError):
+            return []
+        entries = []
+        for line in lines[1:]:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break  # недописанная строка после сбоя
+        return entries
+
+    def _read_state(self) -> list:
+        self.loaded_files = None
+        if not self.path.exists():
+            self.snapshot_digest = None
+            self.journal_entries = 0
+            return []
+        raw = self.path.read_bytes()
+        self.snapshot_digest = self._digest(raw)
+        entries = self._read_journal()
+        self.journal_entries = len(entries)
+        snapshot = json.loads(raw.decode('utf-8'))
+        missing_ids = any(not record.get("id") for record in snapshot)
+        data = [Record(record) for record in replay_journal(snapshot, entries)]
+        if missing_ids and not self.readonly_mode:
+            # База из прежней версии: выданные записям id сразу закрепляются в новом снимке
+            self._write_snapshot(data)
+            log_action("Записям базы присвоены постоянные идентификаторы")
+        self.loaded_files = [self._file_signature(self.path, self.snapshot_digest),
+                             self._file_signature(self.journal_path, self.journal_digest)]
+        self.known_files = self.loaded_files
+        return data
+
+    def load(self) -> list:
+        with self.lock:
+            self.external_change = False
+            self.cache_behind = False
+            data = self._load_cache()
+            self.from_cache = data is not None
+            if data is None:
+                data = self._read_state()
+        self._maybe_compact()
+        return data
+
+    @staticmethod
+    def _file_signature(path: Path, digest) -> list:
+        try:
+            stat = path.stat()
+        except OSError:
+            return [-1, 0, None]
+        return [stat.st_size, stat.st_mtime_ns, digest]
+
+    def _signature_matches(self, path: Path, signature) -> bool:
+        """Сверяет файл с подписью: размер и mtime, а при несовпадении mtime — хэш содержимого."""
+        current = self._file_signature(path, None)
+        if current[0] != signature[0]:
+            return False
+        if current[0] == -1 or current[1] == signature[1]:
+            return True
+        try:
+            return self._digest(path.read_bytes()) == signature[2]
+        except OSError:
+            return False
+
+    def _remember_files(self):
+        self.known_files = [self._file_signature(self.path, self.snapshot_digest),
+                            self._file_signature(self.journal_path, None)]
+
+    def _check_files(self):
+        """Отмечает изменение файлов базы с последней загрузки или записи этим экземпляром."""
+        if self.known_files is not None and not (
+                self._signature_matches(self.path, self.known_files[0])
+                and self._signature_matches(self.journal_path, self.known_files[1])):
+            self.external_change = True
+
+    def changed_externally(self) -> bool:
+        """Изменена ли база другим экземпляром программы; пока идёт своя запись — считается, что нет."""
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            self._check_files()
+            return self.external_change
+        finally:
+            self.lock.release()
+
+    def _load_cache(self):
+        """Возвращает отсортированные записи из base.cache или None, если кэш устарел."""
+        try:
+            with open(self.cache_path, 'rb') as f:
+                header_size = int.from_bytes(f.read(4), 'little')
+                header = marshal.loads(f.read(header_size))
+                if (header.get("version") != CACHE_VERSION
+                        or header.get("python") != list(sys.version_info[:2])
+                        or not self._signature_matches(self.path, header["files"][0])):
+                    return None
+                files = header["files"]
+                tail = []
+                if not self._signature_matches(self.journal_path, files[1]):
+                    # После построения кэша журнал дописывали: хватит применить новые записи
+                    journal = self._journal_tail(files[1], header["snapshot_digest"])
+                    if journal is None:
+                        return None
+                    journal_raw, tail = journal
+                    files = [files[0], self._file_signature(self.journal_path, self._digest(journal_raw))]
+                raw = f.read()
+            gc.disable()  # сборщик мусора заметно тормозит создание миллиона объектов
+            try:
+                # Повторяющиеся строки в кэше записаны ссылками и уже разделяют один объект
+                records = Record.from_parsed_rows(marshal.loads(raw))
+                if tail:
+                    records = self._apply_journal(records, tail)
+            finally:
+                gc.enable()
+        except Exception:
+            return None
+        self.snapshot_digest = header["snapshot_digest"]
+        self.journal_digest = files[1][2]
+        self.journal_entries = header["journal_entries"] + len(tail)
+        self.loaded_files = files
+        self.known_files = self.loaded_files
+        self.cache_behind = bool(tail)
+        return records
+
+    def _journal_tail(self, cached_signature, snapshot_digest):
+        """(содержимое журнала, записи, дописанные после построения кэша) или None, если журнал заменён."""
+        raw = self.journal_path.read_bytes()
+        size, _, digest = cached_signature
+        prefix = raw[:size] if size > 0 else b""
+        if prefix and self._digest(prefix) != digest:
+            return None
+        lines = raw.decode('utf-8').splitlines()
+        if not lines or json.loads(lines[0]).get("snapshot") != snapshot_digest:
+            # Журнал другого снимка при загрузке не применяется: дописанное в него тоже
+            return raw, []
+        entries = []
+        for line in lines[1:][prefix.count(b"\n") - 1 if prefix else 0:]:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break  # недописанная строка после сбоя
+        return raw, entries
+
+    @staticmethod
+    def _apply_journal(records: list, entries) -> list:
+        """Применяет записи журнала к отсортированным записям кэша и восстанавливает порядок по дате."""
+        positions = {record.id: i for i, record in enumerate(records)}
+        for entry in entries:
+            op = entry.get("op")
+            if op == "insert":
+                for data in entry.get("records", []):
+                    record = Record(data)
+                    positions[record.id] = len(records)
+                    records.append(record)
+            elif op == "update":
+                record = Record(entry.get("record", {}))
+                i = positions.get(record.id)
+                if i is not None:
+                    records[i] = record
+            elif op == "delete":
+                i = positions.pop(entry.get("id"), None)
+                if i is not None:
+                    records[i] = None
+        records = [record for record in records if record is not None]
+        records.sort(key=attrgetter("date_ord"), reverse=True)
+        return records
+
+    def refresh_cache(self, sorted_data):
+        """Перестраивает base.cache в фоне по только что загруженным и отсортированным данным,
+        если загрузка шла не из кэша или к кэшу пришлось применять хвост журнала."""
+        if self.readonly_mode or (self.from_cache and not self.cache_behind) or self.loaded_files is None:
+            return
+        if self.cache_thread is not None and self.cache_thread.is_alive():
+            return
+        header = {
+            "version": CACHE_VERSION,
+            "python": list(sys.version_info[:2]),
+            "files": self.loaded_files,
+            "snapshot_digest": self.snapshot_digest,
+            "journal_entries": self.journal_entries,
+        }
+        self.cache_thread = threading.Thread(target=self._write_cache, args=(header, list(sorted_data)), daemon=True)
+        self.cache_thread.start()
+
+    def _write_cache(self, header: dict, data: list):
+        try:
+            # Одинаковые значения (даты, плательщики, поставщики) сохраняются одной строкой:
+            # marshal записывает повторы ссылками, и кэш меньше и быстрее читается
+            pool = {}
+            rows = [(record.id, tuple(pool.setdefault(value, value) for value in record.values)) + record.parsed_row()[2:]
+                    for record in data]
+            raw_header = marshal.dumps(header)
+            atomic_write(self.cache_path, len(raw_header).to_bytes(4, 'little') + raw_header + marshal.dumps(rows))
+        except Exception as e:
+            log_action(f"Не удалось обновить кэш базы: {e}")
+
+    def _write_snapshot(self, data):
+        """Записывает новый снимок base.json и начинает пустой журнал."""
+        raw = json.dumps([record.to_dict() for record in data], ensure_ascii=False, indent=4).encode('utf-8')
+        atomic_write(self.path, raw)
+        self.snapshot_digest = self._digest(raw)
+        self._reset_journal()
+        self._remember_files()
+
+    def _reset_journal(self):
+        header = json.dumps({"snapshot": self.snapshot_digest}) + "\n"
+        atomic_write(self.journal_path, header.encode('utf-8'))
+        self.journal_entries = 0
+
+    def _sync_journal(self):
+        """Сверяет base.journal на диске с текущим base.json перед дописыванием: папку базы могут
+        менять другие экземпляры. Журнал того же снимка дописывается, иначе начинается новый."""
+        if self.known_files is None or not self._signature_matches(self.path, self.known_files[0]):
+            self.snapshot_digest = self._digest(self.path.read_bytes()) if self.path.exists() else None
+        try:
+            raw = self.journal_path.read_bytes()
+        except FileNotFoundError:
+            raw = b""
+        try:
+            current = bool(raw) and json.loads(raw.split(b"\n", 1)[0]).get("snapshot") == self.snapshot_digest
+        except (ValueError, AttributeError):
+            current = False
+        if not current:
+            self._reset_journal()
+            return
+        if not raw.endswith(b"\n"):
+            # Недописанная строка после сбоя другого экземпляра: отбрасывается, чтобы не склеиться с новой
+            raw = raw[:raw.rindex(b"\n") + 1]
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(len(raw))
+        self.journal_entries = raw.count(b"\n") - 1
+
+    def _append(self, entry: dict):
+        with self.lock:
+            if self.snapshot_digest is None:
+                self._read_state()
+            self._check_files()
+            self._sync_journal()
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_entries += 1
+            self._remember_files()
+        self._maybe_compact()
+
+    def save_all(self, data):
+        with self.lock:
+            self._write_snapshot(data)
+
+    def insert(self, records):
+        self._append({"op": "insert", "records": [record.to_dict() for record in records]})
+
+    def update(self, record):
+        self._append({"op": "update", "record": record.to_dict()})
+
+    def delete(self, record):
+        self._append({"op": "delete", "id": record.id})
+
+    def _needs_compaction(self) -> bool:
+        if self.journal_entries >= JOURNAL_MAX_ENTRIES:
+            return True
+        try:
+            return self.journal_entries > 0 and self.journal_path.stat().st_size >= JOURNAL_MAX_BYTES
+        except OSError:
+            return False
+
+    def _maybe_compact(self):
+        if self.readonly_mode or not self._needs_compaction():
+            return
+        if self.compaction_thread is not None and self.compaction_thread.is_alive():
+            return
+        self.compaction_thread = threading.Thread(target=self.compact, daemon=True)
+        self.compaction_thread.start()
+
+    def compact(self):
+        """Сворачивает журнал в новый снимок base.json (выполняется в фоне).
+
+        Блокировка берётся только на чтение файлов и на их замену: разбор и запись нового снимка идут
+        без неё, а строки, дописанные в журнал за это время, переносятся в новый журнал."""
+        snapshot_temp = temp_path_for(self.path)
+        journal_temp = temp_path_for(self.journal_path)
+        try:
+            with self.lock:
+                self._check_files()
+                snapshot_signature = self._file_signature(self.path, None)
+                raw = self.path.read_bytes()
+                journal_raw = self.journal_path.read_bytes()
+
+            snapshot_digest = self._digest(raw)
+            snapshot_signature[2] = snapshot_digest
+            lines = journal_raw.decode('utf-8').splitlines()
+            entries = []
+            if lines and json.loads(lines[0]).get("snapshot") == snapshot_digest:
+                for line in lines[1:]:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+            data = [Record(record) for record in replay_journal(json.loads(raw.decode('utf-8')), entries)]
+            new_raw = json.dumps([record.to_dict() for record in data], ensure_ascii=False, indent=4).encode('utf-8')
+            new_digest = self._digest(new_raw)
+            with open(snapshot_temp, 'wb') as f:
+                f.write(new_raw)
+                f.flush()
+                os.fsync(f.fileno())
+
+            with self.lock:
+                self._check_files()
+                journal_now = self.journal_path.read_bytes() if self.journal_path.exists() else b""
+                if (not self._signature_matches(self.path, snapshot_signature)
+                        or not journal_raw or not journal_now.startswith(journal_raw)):
+                    # Снимок или журнал заменены (сохранение всей базы, другой экземпляр): свёртка устарела
+                    snapshot_temp.unlink()
+                    log_action("Свёртка журнала базы отменена: файлы базы изменились")
+                    return
+                tail = journal_now[len(journal_raw):]
+                header = json.dumps({"snapshot": new_digest}) + "\n"
+                with open(journal_temp, 'wb') as f:
+                    f.write(header.encode('utf-8') + tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(snapshot_temp, self.path)
+                os.replace(journal_temp, self.journal_path)
+                fsync_dir(self.path.parent)
+                self.snapshot_digest = new_digest
+                self.journal_entries = tail.count(b"\n")
+                self._remember_files()
+            log_action(f"Журнал базы свёрнут в снимок ({len(entries)} изменений)")
+        except Exception as e:
+            for temp_path in (snapshot_temp, journal_temp):
+                try:
+                    temp_path.unlink()
+                except OSError:
+                    pass
+            log_action(f"Не удалось свернуть журнал базы: {e}")
+
+    def backup(self, timestamp: str) -> Path:
+        backup_path = self.path.with_name(f"base_{timestamp}.json")
+        with self.lock:
+            shutil.copy2(self.path, backup_path)
+            if self.journal_path.exists():
+                shutil.copy2(self.journal_path, self.journal_path.with_name(f"base_{timestamp}.journal"))
+        return backup_path
+
+    def close(self):
+        for thread in (self.compaction_thread, self.cache_thread):
+            if thread is not None:
+                thread.join()
+
+
+class SqliteStorage:
+    """Хранение реестра в base.db (SQLite, WAL): изменения пишутся построчно."""
+    name = "sqlite"
+    from_cache = False
+
+    def __init__(self, base_dir: Path, readonly_mode: bool):
+        self.path = base_dir / "base.db"
+        self.readonly_mode = readonly_mode
+        self.conn = None
+        self.data_version = None  # PRAGMA data_version на момент загрузки
+
+    def connect(self):
+        if self.conn is not None:
+            return self.conn
+        if self.readonly_mode:
+            self.conn = sqlite3.connect(f"{self.path.as_uri()}?mode=ro", uri=True)
+            return self.conn
+        self.conn = sqlite3.connect(str(self.path))
+        try:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError:
+            pass  # Например, файловая система не поддерживает WAL
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        fields = ", ".join(f"{field} TEXT NOT NULL DEFAULT ''" for field in SQLITE_FIELDS.values())
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS invoices (id INTEGER PRIMARY KEY, uid TEXT, {fields})")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(invoices)")}
+        if "uid" not in columns:
+            self.conn.execute("ALTER TABLE invoices ADD COLUMN uid TEXT")
+        missing = self.conn.execute("SELECT id FROM invoices WHERE uid IS NULL OR uid = ''").fetchall()
+        self.conn.executemany("UPDATE invoices SET uid = ? WHERE id = ?", [(new_record_id(), row[0]) for row in missing])
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS invoices_uid ON invoices (uid)")
+        self.conn.commit()
+        return self.conn
+
+    def ensure_exists(self):
+        self.connect()
+
+    @staticmethod
+    def _row_values(record) -> list:
+        return [str(record.get(col, "")) for col in COLUMNS]
+
+    def load(self) -> list:
+        if self.readonly_mode and not self.path.exists():
+            return []
+        fields = ", ".join(SQLITE_FIELDS.values())
+        conn = self.connect()
+        rows = conn.execute(f"SELECT uid, {fields} FROM invoices ORDER BY id").fetchall()
+        self.data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        return [Record(zip(["id"] + COLUMNS, row)) for row in rows]
+
+    def changed_externally(self) -> bool:
+        """Изменена ли база другим соединением (свои записи data_version не меняют)."""
+        if self.conn is None or self.data_version is None:
+            return False
+        return self.conn.execute("PRAGMA data_version").fetchone()[0] != self.data_version
+
+    def _insert_rows(self, conn, records):
+        fields = ", ".join(SQLITE_FIELDS.values())
+        placeholders = ", ".join("?" * (len(SQLITE_FIELDS) + 1))
+        conn.executemany(f"INSERT INTO invoices (uid, {fields}) VALUES ({placeholders})",
+                         [[record.id] + self._row_values(record) for record in records])
+
+    def insert(self, records):
+        with self.connect() as conn:
+            self._insert_rows(conn, records)
+
+    def update(self, record):
+        assignments = ", ".join(f"{field} = ?" for field in SQLITE_FIELDS.values())
+        with self.connect() as conn:
+            conn.execute(f"UPDATE invoices SET {assignments} WHERE uid = ?", self._row_values(record) + [record.id])
+
+    def delete(self, record):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM invoices WHERE uid = ?", (record.id,))
+
+    def save_all(self, data):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM invoices")
+            self._insert_rows(conn, data)
+
+    def is_empty(self) -> bool:
+        return self.connect().execute("SELECT 1 FROM invoices LIMIT 1").fetchone() is None
+
+    def migrate_from_json(self, json_storage: "JsonStorage") -> int:
+        """Однократный перенос записей из base.json в пустую базу SQLite."""
+        if not self.is_empty():
+            return 0
+        data = json_storage.load()
+        self.insert(data)
+        return len(data)
+
+    def export_to_json(self, json_storage: "JsonStorage") -> int:
+        data = self.load()
+        json_storage.save_all(data)
+        return len(data)
+
+    def backup(self, timestamp: str) -> Path:
+        backup_path = self.path.with_name(f"base_{timestamp}.db")
+        dest = sqlite3.connect(str(backup_path))
+        try:
+            self.connect().backup(dest)
+        finally:
+            dest.close()
+        return backup_path
+
+    def refresh_cache(self, sorted_data):
+        pass
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def open_storage(base_dir: Path, readonly_mode: bool):
+    """Выбирает движок хранения: SQLite, если в папке базы есть base.db, иначе base.json."""
+    if (base_dir / "base.db").exists():
+        return SqliteStorage(base_dir, readonly_mode)
+    return JsonStorage(base_dir, readonly_mode)
 
 
 class PayersManager:
@@ -149,8 +1321,7 @@ class PayersManager:
         if self.readonly_mode:
             return
         try:
-            with open(self.solutor_path, 'w', encoding='utf-8') as f:
-                json.dump(self.payers, f, ensure_ascii=False, indent=4)
+            atomic_write_json(self.solutor_path, self.payers)
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось сохранить список плательщиков:\n{e}")
 
@@ -202,6 +1373,917 @@ class PayersManager:
                 widget.config(state='disabled')
 
 
+def longest_increasing_subsequence(values) -> list:
+    """Индексы элементов одной из наибольших возрастающих подпоследовательностей values."""
+    tails = []  # наименьшее последнее значение подпоследовательности каждой длины
+    tail_indexes = []
+    previous = [-1] * len(values)
+    for i, value in enumerate(values):
+        j = bisect.bisect_left(tails, value)
+        if j == len(tails):
+            tails.append(value)
+            tail_indexes.append(i)
+        else:
+            tails[j] = value
+            tail_indexes[j] = i
+        previous[i] = tail_indexes[j - 1] if j else -1
+    result = []
+    i = tail_indexes[-1] if tail_indexes else -1
+    while i != -1:
+        result.append(i)
+        i = previous[i]
+    result.reverse()
+    return result
+
+
+class TableView:
+    """Отображение записей в ttk.Treeview.
+
+    Результат до VIRTUAL_TABLE_MIN_ROWS строк вставляется целиком, iid строки — id записи.
+    Больший результат показывается виртуально: в Treeview есть только строки окна (сколько
+    помещается по высоте, не больше VIRTUAL_WINDOW_ROWS), полоса прокрутки соответствует полному
+    числу строк, а при прокрутке в строках окна подменяются значения.
+
+    Обновление применяет к Treeview только разницу с тем, что уже показано: удаление,
+    вставку и перемещение изменившихся строк и замену значений у изменённых записей.
+    Вставка и перемещение строк идут порциями через цикл событий Tk с индикатором progress;
+    новый вызов show() отменяет незаконченное заполнение."""
+
+    def __init__(self, tree, scrollbar, progress=None):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.progress = progress
+        self.all_data = []
+        self.rows = array('q')  # позиции в all_data отображаемых записей по порядку
+        self.virtual = False
+        self.top = 0  # первая строка окна в виртуальном режиме
+        self.window = VIRTUAL_WINDOW_ROWS
+        self.slot_ids = []  # строка окна -> id показанной в ней записи
+        self.slot_values = []  # строка окна -> показанные в ней значения
+        self.shown_values = {}  # id -> показанные значения строк Treeview (при показе целиком)
+        self.detached = set()  # строки, отсоединённые для перемещения и ещё не возвращённые
+        self.fill_job = None
+        self.selected_id = None  # выделенная запись в виртуальном режиме (может быть вне окна)
+
+        tree.configure(yscrollcommand=self._on_tree_yscroll)
+        scrollbar.configure(command=self._on_scrollbar)
+        tree.bind("<Configure>", self._on_configure, add="+")
+        tree.bind("<MouseWheel>", lambda e: self._on_wheel(-1 if e.delta > 0 else 1), add="+")
+        tree.bind("<Button-4>", lambda e: self._on_wheel(-1), add="+")
+        tree.bind("<Button-5>", lambda e: self._on_wheel(1), add="+")
+        tree.bind("<Up>", lambda e: self._on_key(-1), add="+")
+        tree.bind("<Down>", lambda e: self._on_key(1), add="+")
+        tree.bind("<Prior>", lambda e: self._on_key(-self.window), add="+")
+        tree.bind("<Next>", lambda e: self._on_key(self.window), add="+")
+        tree.bind("<Home>", lambda e: self._on_key(-len(self.rows)), add="+")
+        tree.bind("<End>", lambda e: self._on_key(len(self.rows)), add="+")
+
+    def show(self, all_data, rows, keep_position=False):
+        """Показывает записи all_data[position] для position из rows в заданном порядке."""
+        self.all_data = all_data
+        self.rows = rows
+        self._cancel_fill()
+        virtual = len(rows) > VIRTUAL_TABLE_MIN_ROWS
+        if virtual != self.virtual:
+            self.tree.delete(*self.tree.get_children())
+            self.tree.configure(selectmode='browse' if virtual else 'extended')
+            self.virtual = virtual
+            self.slot_ids = []
+            self.slot_values = []
+            self.shown_values = {}
+            self.selected_id = None
+            keep_position = False
+        if not virtual:
+            self._fill_all()
+            return
+        if not keep_position:
+            self.top = 0
+        self._fill()
+
+    def selected_ids(self) -> list:
+        """id выделенных записей."""
+        if not self.virtual:
+            return list(self.tree.selection())
+        self._sync_selection()
+        return [self.selected_id] if self.selected_id is not None else []
+
+    def _cancel_fill(self):
+        if self.fill_job is not None:
+            self.tree.after_cancel(self.fill_job)
+            self.fill_job = None
+        # Строки, отсоединённые прерванным заполнением, удаляются: следующее начнёт с видимых
+        if self.detached:
+            self.tree.delete(*self.detached)
+            for record_id in self.detached:
+                self.shown_values.pop(record_id, None)
+            self.detached = set()
+        if self.progress is not None:
+            self.progress.grid_remove()
+
+    def _fill_all(self):
+        tree = self.tree
+        all_data = self.all_data
+        records = [all_data[position] for position in self.rows]
+        new_index = {record.id: i for i, record in enumerate(records)}
+        shown_values = self.shown_values
+        shown_ids = tree.get_children()
+
+        removed = [record_id for record_id in shown_ids if record_id not in new_index]
+        if removed:
+            tree.delete(*removed)
+            for record_id in removed:
+                del shown_values[record_id]
+        # Строки наибольшей возрастающей (по новому порядку) подпоследовательности остаются на месте,
+        # остальные отсоединяются и возвращаются на новые места
+        kept = [record_id for record_id in shown_ids if record_id in new_index]
+        in_place = {kept[i] for i in longest_increasing_subsequence([new_index[record_id] for record_id in kept])}
+        moved = [record_id for record_id in kept if record_id not in in_place]
+        if moved:
+            tree.detach(*moved)
+        self.detached = set(moved)
+        self._fill_all_step(records, 0)
+
+    def _fill_all_step(self, records, start):
+        # Строки records[:start] уже стоят на своих местах
+        tree = self.tree
+        shown_values = self.shown_values
+        detached = self.detached
+        deadline = time.perf_counter() + TABLE_FILL_SLICE_SECONDS
+        i = start
+        while i < len(records):
+            record = records[i]
+            values = shown_values.get(record.id)
+            if values is None:
+                tree.insert('', i, iid=record.id, values=record.values)
+            else:
+                if record.id in detached:
+                    tree.move(record.id, '', i)
+                    detached.discard(record.id)
+                if values != record.values:
+                    tree.item(record.id, values=record.values)
+            shown_values[record.id] = record.values
+            i += 1
+            if i % 64 == 0 and i < len(records) and time.perf_counter() > deadline:
+                if self.progress is not None:
+                    self.progress['value'] = 100 * i / len(records)
+                    self.progress.grid()
+                self.fill_job = tree.after(1, self._fill_all_step, records, i)
+                return
+        self.fill_job = None
+        if self.progress is not None:
+            self.progress.grid_remove()
+
+    def _window_rows(self) -> int:
+        """Сколько строк помещается в Treeview по высоте (пока окно не показано — VIRTUAL_WINDOW_ROWS)."""
+        height = self.tree.winfo_height()
+        bbox = self.tree.bbox("row0") if self.slot_ids else None
+        if height <= 1 or not bbox:
+            return self.window
+        return max(1, min(VIRTUAL_WINDOW_ROWS, (height - bbox[1]) // bbox[3]))
+
+    def _sync_selection(self):
+        # Выделение строки окна переносится на запись, которая в ней показана
+        selection = self.tree.selection()
+        if selection:
+            self.selected_id = self.slot_ids[int(selection[0][3:])]
+        elif self.selected_id in self.slot_ids:
+            self.selected_id = None
+
+    def _fill(self):
+        tree = self.tree
+        all_data = self.all_data
+        rows = self.rows
+        self._sync_selection()
+        self.window = self._window_rows()
+        total = len(rows)
+        count = min(self.window, total)
+        self.top = max(0, min(self.top, total - count))
+
+        slots = tree.get_children()
+        if len(slots) > count:
+            tree.delete(*slots[count:])
+        for i in range(len(slots), count):
+            tree.insert('', tk.END, iid=f"row{i}")
+        slot_values = self.slot_values
+        del slot_values[count:]
+        slot_ids = []
+        selected_slot = None
+        for i in range(count):
+            record = all_data[rows[self.top + i]]
+            if i == len(slot_values):
+                slot_values.append(record.values)
+                tree.item(f"row{i}", values=record.values)
+            elif slot_values[i] != record.values:
+                slot_values[i] = record.values
+                tree.item(f"row{i}", values=record.values)
+            slot_ids.append(record.id)
+            if record.id == self.selected_id:
+                selected_slot = f"row{i}"
+        self.slot_ids = slot_ids
+        tree.selection_set(selected_slot if selected_slot is not None else ())
+        tree.yview_moveto(0)
+        if total:
+            self.scrollbar.set(self.top / total, (self.top + count) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def scroll_to(self, top: int):
+        top = max(0, min(top, len(self.rows) - self.window))
+        if top != self.top:
+            self.top = top
+            self._fill()
+
+    def _on_tree_yscroll(self, first, last):
+        if not self.virtual:
+            self.scrollbar.set(first, last)
+
+    def _on_scrollbar(self, *args):
+        if not self.virtual:
+            self.tree.yview(*args)
+            return
+        if args[0] == "moveto":
+            self.scroll_to(round(float(args[1]) * len(self.rows)))
+        elif args[0] == "scroll":
+            step = int(args[1])
+            if args[2] == "pages":
+                step *= self.window
+            self.scroll_to(self.top + step)
+
+    def _on_configure(self, event):
+        if self.virtual:
+            self._fill()
+
+    def _on_wheel(self, direction: int):
+        if not self.virtual:
+            return None
+        self.scroll_to(self.top + direction * 3)
+        return "break"
+
+    def _on_key(self, step: int):
+        # Клавиши перемещения выделения прокручивают окно, когда выходят за его край
+        if not self.virtual or not self.rows:
+            return None
+        focus = self.tree.focus()
+        current = self.top + int(focus[3:]) if focus.startswith("row") else self.top
+        target = max(0, min(len(self.rows) - 1, current + step))
+        if target < self.top:
+            self.scroll_to(target)
+        elif target >= self.top + self.window:
+            self.scroll_to(target - self.window + 1)
+        slot = f"row{target - self.top}"
+        self.selected_id = self.slot_ids[target - self.top]
+        self.tree.selection_set(slot)
+        self.tree.focus(slot)
+        return "break"
+
+
+class ChartPanel:
+    """Окно графиков: один Figure на FigureCanvasTkAgg, который перерисовывается при смене типа
+    графика и при изменении отображаемых записей (новые фигуры не создаются).
+
+    Простые графики с теми же столбцами обновляются на месте (высоты и подписи), остальные
+    перестраиваются в том же Figure. Закрытие окна только скрывает его."""
+    TYPES = [
+        ("yearly_total", "Общий по годам"),
+        ("payer_comparison", "Сравнение плательщиков по годам"),
+        ("yearly_detail", "Детализация по годам"),
+        ("monthly_current", "По месяцам (текущий год)"),
+    ]
+    MONTHS = ["Янв", "Фев", "Мар", "Апр", "Май", "Июн", "Июл", "Авг", "Сен", "Окт", "Ноя", "Дек"]
+
+    def __init__(self, parent, cube_source):
+        self.parent = parent
+        self.cube_source = cube_source  # функция, возвращающая куб итогов отображаемых записей
+        self.window = None
+        self.figure = None
+        self.canvas = None
+        self.chart_type = None
+        self.drawn = None  # (тип, подписи столбцов) графика, который можно обновить на месте
+        self.bars = []
+        self.annotations = []
+        self.redraw_job = None
+
+    def show(self):
+        if self.window is None:
+            self._build()
+        self.window.deiconify()
+        self.window.lift()
+        self.redraw()
+
+    def _build(self):
+        self.window = tk.Toplevel(self.parent)
+        self.window.title("Графики")
+        self.window.geometry("1200x760")
+        self.window.protocol("WM_DELETE_WINDOW", self.window.withdraw)
+
+        type_frame = tk.Frame(self.window)
+        type_frame.pack(side=tk.TOP, fill=tk.X, padx=10, pady=5)
+        self.chart_type = tk.StringVar(value="yearly_total")
+        for value, text in self.TYPES:
+            tk.Radiobutton(type_frame, text=text, variable=self.chart_type, value=value,
+                           font=("Arial", 10), command=self.redraw).pack(side=tk.LEFT, padx=5)
+
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+        self.figure = Figure(figsize=(12, 7), layout="tight")
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self.window)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+
+    def visible(self) -> bool:
+        return self.window is not None and self.window.state() != "withdrawn"
+
+    def schedule_redraw(self):
+        """Перерисовка после изменения фильтров или данных (несколько изменений — одна перерисовка)."""
+        if self.visible() and self.redraw_job is None:
+            self.redraw_job = self.window.after_idle(self.redraw)
+
+    def redraw(self):
+        self.redraw_job = None
+        cube = self.cube_source()
+        kind = self.chart_type.get()
+        if kind == "yearly_total":
+            self._draw_yearly_total(cube)
+        elif kind == "payer_comparison":
+            self._draw_payer_comparison(cube)
+        elif kind == "yearly_detail":
+            self._draw_yearly_detail(cube)
+        elif kind == "monthly_current":
+            self._draw_monthly(cube)
+        self.canvas.draw_idle()
+
+    @staticmethod
+    def _style(ax, title, xlabel=None):
+        from matplotlib.ticker import FuncFormatter
+
+        ax.set_title(title, fontsize=16, fontweight='bold')
+        if xlabel:
+            ax.set_xlabel(xlabel, fontsize=12)
+        ax.set_ylabel("Сумма (руб.)", fontsize=12)
+        ax.yaxis.set_major_formatter(FuncFormatter(lambda x, _: f'{int(x):,}'.replace(',', ' ')))
+        ax.grid(axis='y', linestyle='--', alpha=0.7)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.set_facecolor('#f8f9fa')
+
+    @staticmethod
+    def _annotate(ax, x, total):
+        return ax.annotate(format_money(total, with_kopecks=False), xy=(x, total / 100), xytext=(0, 3),
+                           textcoords="offset points", ha='center', va='bottom', fontweight='bold')
+
+    def _no_data(self):
+        self.figure.clear()
+        self.drawn = None
+        ax = self.figure.add_subplot()
+        ax.set_axis_off()
+        ax.text(0.5, 0.5, "Нет данных для графика", ha='center', va='center', fontsize=14, transform=ax.transAxes)
+
+    def _bar_chart(self, kind, positions, tick_labels, totals, title, xlabel, color):
+        """Простой столбчатый график; при том же типе и тех же столбцах меняются только высоты и подписи."""
+        heights = [total / 100 for total in totals]
+        if self.drawn == (kind, tuple(tick_labels)):
+            for bar, annotation, height, total in zip(self.bars, self.annotations, heights, totals):
+                bar.set_height(height)
+                annotation.xy = (bar.get_x() + bar.get_width() / 2, height)
+                annotation.set_text(format_money(total, with_kopecks=False))
+                annotation.set_visible(total > 0)
+            ax = self.figure.axes[0]
+            ax.set_title(title, fontsize=16, fontweight='bold')
+            ax.relim()
+            ax.autoscale_view()
+            return
+        self.figure.clear()
+        ax = self.figure.add_subplot()
+        self.bars = list(ax.bar(positions, heights, color=color))
+        self.annotations = []
+        for bar, total in zip(self.bars, totals):
+            annotation = self._annotate(ax, bar.get_x() + bar.get_width() / 2, total)
+            annotation.set_visible(total > 0)
+            self.annotations.append(annotation)
+        ax.set_xticks(positions)
+        ax.set_xticklabels(tick_labels)
+        self._style(ax, title, xlabel)
+        self.drawn = (kind, tuple(tick_labels))
+
+    def _draw_yearly_total(self, cube):
+        yearly_totals = {year: amount for year, amount in cube.group("year").items() if year}
+        if not yearly_totals:
+            self._no_data()
+            return
+        years = sorted(yearly_totals)
+        self._bar_chart("yearly_total", years, [str(year) for year in years],
+                        [yearly_totals[year] for year in years], "Общие затраты по годам", "Год", 'steelblue')
+
+    def _draw_monthly(self, cube):
+        current_year = datetime.now().year
+        monthly_totals = cube.group("month", year=current_year)
+        self._bar_chart("monthly_current", list(range(12)), self.MONTHS,
+                        [monthly_totals.get(month, 0) for month in range(1, 13)],
+                        f"Затраты по месяцам за {current_year} год", "Месяц", 'teal')
+
+    @staticmethod
+    def _yearly_payer_totals(cube) -> dict:
+        """{год: {плательщик: сумма в копейках}} для записей с корректной датой и указанным плательщиком."""
+        yearly_payer_totals = {}
+        for (year, payer), amount in cube.group("year", "payer").items():
+            if year and payer:
+                yearly_payer_totals.setdefault(year, {})[payer] = amount
+        return yearly_payer_totals
+
+    def _draw_payer_comparison(self, cube):
+        import matplotlib
+        yearly_payer_totals = self._yearly_payer_totals(cube)
+        if not yearly_payer_totals:
+            self._no_data()
+            return
+        self.figure.clear()
+        self.drawn = None
+        ax = self.figure.add_subplot()
+
+        years = sorted(yearly_payer_totals)
+        all_payers = sorted({payer for year_data in yearly_payer_totals.values() for payer in year_data})
+        colors = matplotlib.colormaps["tab20"](np.linspace(0, 1, len(all_payers)))
+        bottom = np.zeros(len(years))
+        for i, payer in enumerate(all_payers):
+            heights = np.array([yearly_payer_totals[year].get(payer, 0) for year in years]) / 100
+            ax.bar(years, heights, bottom=bottom, label=payer, color=colors[i])
+            bottom += heights
+        for year in years:
+            self._annotate(ax, year, sum(yearly_payer_totals[year].values()))
+
+        ax.legend(title="Плательщики", bbox_to_anchor=(1.05, 1), loc='upper left')
+        ax.set_xticks(years)
+        ax.set_xticklabels([str(year) for year in years])
+        self._style(ax, "Сравнение затрат по плательщикам по годам", "Год")
+
+    def _draw_yearly_detail(self, cube):
+        import matplotlib
+        yearly_payer_totals = self._yearly_payer_totals(cube)
+        if not yearly_payer_totals:
+            self._no_data()
+            return
+        self.figure.clear()
+        self.drawn = None
+
+        years = sorted(yearly_payer_totals)
+        cols = 2 if len(years) > 1 else 1
+        rows = (len(years) + cols - 1) // cols
+        axes = self.figure.subplots(rows, cols, squeeze=False).flatten()
+        all_payers = sorted({payer for year_data in yearly_payer_totals.values() for payer in year_data})
+        colors = matplotlib.colormaps["tab20"](np.linspace(0, 1, len(all_payers)))
+        payer_colors = {payer: colors[i] for i, payer in enumerate(all_payers)}
+
+        for ax, year in zip(axes, years):
+            sorted_payers = sorted(yearly_payer_totals[year].items(), key=lambda x: x[1], reverse=True)
+            payers = [payer for payer, _ in sorted_payers]
+            amounts = [amount for _, amount in sorted_payers]
+            bars = ax.bar(payers, [amount / 100 for amount in amounts], color=[payer_colors[payer] for payer in payers])
+            for bar, amount in zip(bars, amounts):
+                self._annotate(ax, bar.get_x() + bar.get_width() / 2, amount)
+            self._style(ax, f"Затраты по плательщикам за {year} год")
+            ax.title.set_fontsize(14)
+            ax.tick_params(axis='x', rotation=45)
+        for ax in axes[len(years):]:
+            ax.set_visible(False)
+
+
+class FlowableStream(list):
+    """Список flowable для doc.build, который берёт следующие элементы из генератора по мере вёрстки:
+    в памяти только несколько ещё не выведенных элементов."""
+
+    def __init__(self, source, ahead: int = 2):
+        super().__init__()
+        self.source = iter(source)
+        self.ahead = ahead
+        self._fill()
+
+    def _fill(self):
+        while list.__len__(self) < self.ahead:
+            item = next(self.source, None)
+            if item is None:
+                break
+            self.append(item)
+
+    def __len__(self):
+        self._fill()
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        self._fill()
+        return list.__getitem__(self, index)
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._fill()
+
+
+def pdf_column_widths(columns, total_width: float) -> list:
+    """Ширины колонок реестра в PDF: обоснованию больше всего места."""
+    col_widths = []
+    for col in columns:
+        if col == "Обоснование":
+            col_widths.append(total_width * 0.30)
+        elif col in ("Комментарии", "Поставщик", "Плательщик"):
+            col_widths.append(total_width * 0.12)
+        else:
+            col_widths.append(total_width * 0.07)
+    actual_sum = sum(col_widths)
+    return [w * total_width / actual_sum for w in col_widths]
+
+
+def write_register_pdf(file_path, columns, records, total_line: str, progress=None):
+    """Пишет реестр в PDF. Строки выводятся таблицами по PDF_CHUNK_ROWS, которые создаются по мере
+    вёрстки, с общим стилем; шапка таблицы на следующих страницах рисуется шаблоном страницы.
+    progress(число строк) вызывается после каждой таблицы."""
+    from xml.sax.saxutils import escape
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    from reportlab.platypus import BaseDocTemplate, Frame, PageTemplate, Table, TableStyle, Paragraph, Spacer
+
+    use_chakra_font = register_chakra_font()
+    body_font = 'ChakraPetch' if use_chakra_font else 'Helvetica'
+    page_width, page_height = landscape(A4)
+    margin = 36
+    total_width = page_width - 2 * margin
+    col_widths = pdf_column_widths(columns, total_width)
+
+    header_style = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, -1), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, -1), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('FONTNAME', (0, 0), (-1, -1), 'ChakraPetch' if use_chakra_font else 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ])
+    body_style = TableStyle([
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('FONTNAME', (0, 0), (-1, -1), body_font),
+        ('FONTSIZE', (0, 0), (-1, -1), PDF_FONT_SIZE),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ])
+    # Перенос по словам (Paragraph) только для значений, которые не помещаются в колонку
+    cell_style = ParagraphStyle('Cell', fontName=body_font, fontSize=PDF_FONT_SIZE,
+                                leading=PDF_FONT_SIZE + 1, alignment=TA_CENTER)
+    text_widths = [width - 12 for width in col_widths]  # минус отступы ячейки слева и справа
+
+    def cell(text, width):
+        if text and stringWidth(text, body_font, PDF_FONT_SIZE) > width:
+            return Paragraph(escape(text), cell_style)
+        return text
+
+    def header():
+        return Table([columns], colWidths=col_widths, style=header_style)
+
+    page_header = header()
+    header_height = page_header.wrap(total_width, page_height)[1]
+
+    def draw_page(canvas, doc):
+        canvas.saveState()
+        canvas.setFont(body_font, 9)
+        canvas.drawRightString(page_width - margin, 20, f"Стр. {canvas.getPageNumber()}")
+        canvas.restoreState()
+
+    def draw_later_page(canvas, doc):
+        draw_page(canvas, doc)
+        page_header.drawOn(canvas, margin, page_height - margin - header_height)
+
+    def flowables():
+        styles = getSampleStyleSheet()
+        title_style = styles['Title'].clone('CustomTitle')
+        total_style = styles['Normal'].clone('Total')
+        if use_chakra_font:
+            title_style.fontName = 'ChakraPetch'
+            total_style.fontName = 'ChakraPetch'
+        title_style.fontSize = 16
+        yield Paragraph("Реестр счетов покупок (Registrum)", title_style)
+        yield Spacer(1, 12)
+        yield Paragraph(escape(total_line), total_style)
+        yield Spacer(1, 12)
+        yield header()
+
+        chunk = []
+        done = 0
+        for record in records:
+            chunk.append([cell(str(record.get(col, "")), width) for col, width in zip(columns, text_widths)])
+            if len(chunk) == PDF_CHUNK_ROWS:
+                yield Table(chunk, colWidths=col_widths, style=body_style)
+                done += len(chunk)
+                chunk = []
+                if progress is not None:
+                    progress(done)
+        if chunk:
+            yield Table(chunk, colWidths=col_widths, style=body_style)
+
+    frame_options = dict(leftPadding=0, rightPadding=0, topPadding=0, bottomPadding=0)
+    doc = BaseDocTemplate(file_path, pagesize=landscape(A4), leftMargin=margin, rightMargin=margin,
+                          topMargin=margin, bottomMargin=margin)
+    doc.addPageTemplates([
+        PageTemplate(id='First', frames=Frame(margin, margin, total_width, page_height - 2 * margin, **frame_options),
+                     onPage=draw_page, autoNextPageTemplate='Later'),
+        PageTemplate(id='Later', frames=Frame(margin, margin, total_width, page_height - 2 * margin - header_height,
+                                              **frame_options),
+                     onPage=draw_later_page),
+    ])
+    doc.build(FlowableStream(flowables()))
+
+
+def write_register_xlsx(file_path, columns, records, total: int, invalid_amounts: int = 0, progress=None):
+    """Пишет реестр в Excel потоково (write_only): строки сразу уходят в файл, оформление — общими
+    именованными стилями. Суммы записываются числами, итог — числовой ячейкой в колонке "Сумма".
+    progress(число строк) вызывается каждые EXPORT_PROGRESS_ROWS строк."""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import NamedStyle, Font, Alignment, PatternFill
+    from openpyxl.utils import get_column_letter
+
+    wb = Workbook(write_only=True)
+    wb.add_named_style(NamedStyle(
+        "registrum_header", font=Font(bold=True, color="FFFFFF"),
+        fill=PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid"),
+        alignment=Alignment(horizontal="center", vertical="center")))
+    wb.add_named_style(NamedStyle("registrum_text", alignment=Alignment(wrap_text=True, vertical="top")))
+    wb.add_named_style(NamedStyle("registrum_amount", number_format='#,##0.00',
+                                  alignment=Alignment(vertical="top")))
+    wb.add_named_style(NamedStyle("registrum_total", font=Font(bold=True), number_format='#,##0.00'))
+    ws = wb.create_sheet("Реестр счетов")
+
+    # Ширины колонок записываются в начало листа, до строк, поэтому считаются заранее
+    # по длинам значений (без создания ячеек) и не больше EXCEL_MAX_COLUMN_WIDTH
+    limit = EXCEL_MAX_COLUMN_WIDTH - 2
+    indexes = [COLUMN_INDEX[col] for col in columns]
+    lengths = [len(col) for col in columns]
+    for record in records:
+        values = record.values
+        for i, index in enumerate(indexes):
+            length = len(values[index])
+            if length > lengths[i]:
+                lengths[i] = length
+    for i, length in enumerate(lengths, 1):
+        ws.column_dimensions[get_column_letter(i)].width = min(length, limit) + 2
+
+    def cell(value, style):
+        cell = WriteOnlyCell(ws, value)
+        cell.style = style
+        return cell
+
+    ws.append([cell(col, "registrum_header") for col in columns])
+    amount_index = COLUMN_INDEX["Сумма"]
+    for done, record in enumerate(records, 1):
+        values = record.values
+        row = []
+        for index in indexes:
+            value = values[index]
+            if not value:
+                row.append(None)  # пустые ячейки в файл не пишутся
+            elif index == amount_index and record.amount_valid:
+                row.append(cell(Decimal(record.amount).scaleb(-2), "registrum_amount"))
+            else:
+                row.append(cell(value, "registrum_text"))
+        ws.append(row)
+        if progress is not None and done % EXPORT_PROGRESS_ROWS == 0:
+            progress(done)
+
+    # Итоговая строка: подпись, сумма числом и, если есть, число некорректных сумм
+    amount_col = columns.index("Сумма")
+    total_row = [None] * len(columns)
+    total_row[amount_col - 1] = cell("Итого:", "registrum_total")
+    total_row[amount_col] = cell(Decimal(total).scaleb(-2), "registrum_total")
+    if invalid_amounts:
+        total_row[-1] = cell(f"Записей с некорректной суммой, не вошедших в итог: {invalid_amounts}", "registrum_text")
+    ws.append(total_row)
+    wb.save(file_path)
+
+
+def write_register_csv(file_path, columns, records, progress=None):
+    """Пишет реестр в CSV в том же формате, что читает импорт (UTF-8 с BOM, разделитель ";")."""
+    indexes = [COLUMN_INDEX[col] for col in columns]
+    with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(columns)
+        for done, record in enumerate(records, 1):
+            values = record.values
+            writer.writerow([values[index] for index in indexes])
+            if progress is not None and done % EXPORT_PROGRESS_ROWS == 0:
+                progress(done)
+
+
+def partition_records(records, mode: str) -> dict:
+    """Делит записи для пакетных отчётов: {(плательщик, год): [записи]}. Год 0 — некорректная дата;
+    в режиме "payer" год, а в режиме "year" плательщик — None."""
+    partitions = {}
+    for record in records:
+        payer = None
+        if mode != "year":
+            payer = record.get("Плательщик", "").strip() or "Без плательщика"
+        year = record.year if mode != "payer" else None
+        partitions.setdefault((payer, year), []).append(record)
+    return partitions
+
+
+def report_file_stem(payer, year) -> str:
+    """Имя файла отчёта без расширения: Реестр_<плательщик>_<год>."""
+    parts = ["Реестр"]
+    if payer is not None:
+        parts.append(re.sub(r'[\\/:*?"<>|\s]+', '_', payer).strip('_.') or "_")
+    if year is not None:
+        parts.append(str(year) if year else "без_даты")
+    return "_".join(parts)
+
+
+def render_report(directory: str, stem: str, kinds, columns, records) -> list:
+    """Пишет отчёты одной части реестра (выполняется в процессе пула). Возвращает имена созданных файлов."""
+    total = sum(record.amount for record in records)
+    invalid_amounts = sum(1 for record in records if not record.amount_valid)
+    files = []
+    if "PDF" in kinds:
+        path = Path(directory) / f"{stem}.pdf"
+        write_register_pdf(str(path), columns, records, format_total_line(total, invalid_amounts))
+        files.append(path.name)
+    if "Excel" in kinds:
+        path = Path(directory) / f"{stem}.xlsx"
+        write_register_xlsx(str(path), columns, records, total, invalid_amounts)
+        files.append(path.name)
+    return files
+
+
+def write_batch_reports(manifest_path, directory, mode: str, kinds, columns, partitions: dict, progress=None):
+    """Формирует отчёты по частям реестра в пуле процессов (по процессу на ядро) и пишет в manifest_path
+    JSON со списком созданных файлов. progress(число частей) вызывается по готовности каждой части."""
+    tasks = []  # (плательщик, год, имя файла без расширения, записи)
+    used_stems = set()
+    for (payer, year), records in sorted(partitions.items(), key=lambda item: (item[0][0] or "", item[0][1] or 0)):
+        stem = base_stem = report_file_stem(payer, year)
+        suffix = 2
+        while stem.lower() in used_stems:  # разные плательщики могут дать одно имя файла
+            stem = f"{base_stem}_{suffix}"
+            suffix += 1
+        used_stems.add(stem.lower())
+        tasks.append((payer, year, stem, records))
+
+    reports = {}
+    workers = max(min(len(tasks), os.cpu_count() or 1), 1)
+    # spawn: дочерние процессы не наследуют потоки и состояние Tk
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(render_report, str(directory), stem, kinds, columns, records): i
+                   for i, (payer, year, stem, records) in enumerate(tasks)}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                reports[futures[future]] = future.result()
+                if progress is not None:
+                    progress(done)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    entries = []
+    for i, (payer, year, stem, records) in enumerate(tasks):
+        total = sum(record.amount for record in records)
+        entry = {}
+        if payer is not None:
+            entry["payer"] = payer
+        if year is not None:
+            entry["year"] = year or None
+        entry.update({
+            "records": len(records),
+            "total": format_money(total),
+            "total_kopecks": total,
+            "invalid_amounts": sum(1 for record in records if not record.amount_valid),
+            "files": reports[i],
+        })
+        entries.append(entry)
+    manifest = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "partition": mode,
+        "formats": list(kinds),
+        "reports": entries,
+    }
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+
+
+class ExportCancelled(Exception):
+    """Выгрузка прервана пользователем."""
+
+
+class ExportJob:
+    """Фоновая выгрузка в файл: write(путь, progress) выполняется в отдельном потоке и пишет во временный
+    файл, который по завершении заменяет целевой. Прогресс и результат передаются через очередь events."""
+
+    def __init__(self, kind: str, file_path, write, total_rows: int, unit: str = "строк", done_text: str = None):
+        self.kind = kind  # "PDF", "Excel", "CSV" — для подписей и сообщений
+        self.file_path = Path(file_path)
+        self.write = write
+        self.total_rows = total_rows
+        self.unit = unit  # единица прогресса в подписи
+        self.done_text = done_text  # сообщение об успехе вместо "Файл ... сохранён"
+        self.events = queue.Queue()  # ("progress", строк) ... и последним ("done" | "cancelled" | "error", ошибка)
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"export-{kind}", daemon=True)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def progress(self, done: int):
+        if self.cancelled.is_set():
+            raise ExportCancelled()
+        self.events.put(("progress", done))
+
+    def _run(self):
+        temp_path = temp_path_for(self.file_path)
+        try:
+            self.write(str(temp_path), self.progress)
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            os.replace(temp_path, self.file_path)
+            self.events.put(("done", None))
+        except ExportCancelled:
+            self.events.put(("cancelled", None))
+        except Exception as e:
+            self.events.put(("error", e))
+        finally:
+            try:
+                temp_path.unlink()
+            except OSError:
+                pass
+
+
+class ExportJobs:
+    """Панель фоновых выгрузок внизу главного окна: по строке с прогрессом и кнопкой отмены на выгрузку.
+    Несколько выгрузок выполняются одновременно; их очереди опрашиваются через root.after."""
+
+    def __init__(self, root):
+        self.root = root
+        self.frame = tk.Frame(root)
+        self.frame.pack(side=tk.BOTTOM, fill=tk.X, padx=10)
+        self.jobs = {}  # задание -> (строка панели, подпись, индикатор)
+        self.poll_job = None
+
+    def start(self, job: ExportJob):
+        row = tk.Frame(self.frame)
+        row.pack(fill=tk.X, pady=1)
+        label = tk.Label(row, text=self._status(job, 0), font=("Arial", 9), anchor='w')
+        bar = ttk.Progressbar(row, orient="horizontal", mode="determinate", maximum=max(job.total_rows, 1), length=200)
+        tk.Button(row, text="Отмена", font=("Arial", 9), command=job.cancel).pack(side=tk.RIGHT)
+        bar.pack(side=tk.RIGHT, padx=5)
+        label.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.jobs[job] = (row, label, bar)
+        job.thread.start()
+        if self.poll_job is None:
+            self.poll_job = self.root.after(EXPORT_POLL_MS, self.poll)
+
+    @staticmethod
+    def _status(job: ExportJob, done: int) -> str:
+        counts = f"{done:,} из {job.total_rows:,}".replace(',', ' ')
+        return f"{job.kind}: {job.file_path.name} — {counts} {job.unit}"
+
+    def running(self) -> bool:
+        return bool(self.jobs)
+
+    def cancel_all(self, timeout: float = 5.0):
+        """Отменяет выгрузки и ждёт, пока потоки уберут временные файлы."""
+        for job in self.jobs:
+            job.cancel()
+        deadline = time.monotonic() + timeout
+        for job in self.jobs:
+            job.thread.join(max(deadline - time.monotonic(), 0))
+
+    def poll(self):
+        self.poll_job = None
+        finished = []
+        for job, (row, label, bar) in list(self.jobs.items()):
+            try:
+                while True:
+                    event, value = job.events.get_nowait()
+                    if event == "progress":
+                        bar['value'] = value
+                        label.config(text=self._status(job, value))
+                    else:
+                        row.destroy()
+                        del self.jobs[job]
+                        finished.append((job, event, value))
+                        break
+            except queue.Empty:
+                pass
+        if self.jobs:
+            self.poll_job = self.root.after(EXPORT_POLL_MS, self.poll)
+
+        for job, event, value in finished:
+            if event == "done":
+                font_error = take_chakra_font_error()
+                if font_error is not None:
+                    messagebox.showwarning("Шрифт", f"Не удалось загрузить шрифт ChakraPetch:\n{font_error}")
+                messagebox.showinfo("Успех", job.done_text or f"Файл {job.kind} сохранён:\n{job.file_path}")
+            elif event == "error":
+                messagebox.showerror("Ошибка", f"Не удалось создать {job.kind}:\n{value}")
+
+
 class RegistrumApp:
     def __init__(self, root):
         self.root = root
@@ -225,10 +2307,15 @@ class RegistrumApp:
         self.readonly_mode = not self.can_write_to_base_dir()
         if self.readonly_mode:
             self.root.title("Registrum — Реестр счетов покупок [Только чтение]")
+        else:
+            recover_temp_files(self.base_dir, RECOVERABLE_FILES)
+
+        self.storage = open_storage(self.base_dir, self.readonly_mode)
 
         try:
             ensure_base_exists(self.base_path)
             ensure_solutor_exists(self.solutor_path)
+            self.storage.ensure_exists()
         except Exception as e:
             if not self.readonly_mode:
                 messagebox.showerror("Ошибка", f"Не удалось создать файлы:\n{e}")
@@ -275,14 +2362,16 @@ class RegistrumApp:
 
         self.btn_pdf = tk.Button(btn_frame, text="В PDF", command=self.export_to_pdf, width=12, height=1)
         self.btn_excel = tk.Button(btn_frame, text="В Excel", command=self.export_to_excel, width=12, height=1)
+        self.btn_csv = tk.Button(btn_frame, text="В CSV", command=self.export_to_csv, width=12, height=1)
         self.btn_import = tk.Button(btn_frame, text="Импорт CSV", command=self.import_from_csv, width=12, height=1)
         self.btn_payers = tk.Button(btn_frame, text="Плательщики", command=self.open_payers_window, width=12, height=1)
         self.btn_settings = tk.Button(btn_frame, text="Настройки", command=self.open_settings, width=12, height=1)
         self.btn_chart = tk.Button(btn_frame, text="График", command=self.show_chart, width=12, height=1)
+        self.btn_reports = tk.Button(btn_frame, text="Отчёты", command=self.open_batch_reports, width=12, height=1)
         self.btn_info = tk.Button(btn_frame, text="Инфо", command=self.show_info, width=12, height=1)
         self.btn_exit = tk.Button(btn_frame, text="Выход", command=self.on_exit, width=12, height=1)
 
-        buttons = [self.btn_pdf, self.btn_excel, self.btn_import, self.btn_payers, self.btn_settings, self.btn_chart, self.btn_info, self.btn_exit]
+        buttons = [self.btn_pdf, self.btn_excel, self.btn_csv, self.btn_import, self.btn_payers, self.btn_settings, self.btn_chart, self.btn_reports, self.btn_info, self.btn_exit]
         for i, btn in enumerate(buttons):
             btn.grid(row=0, column=i, padx=2)
 
@@ -292,24 +2381,31 @@ class RegistrumApp:
             self.btn_payers.config(state='disabled')
             self.btn_import.config(state='disabled')
 
+        # Панель фоновых выгрузок (внизу окна, пуста, пока выгрузок нет)
+        self.export_jobs = ExportJobs(root)
+
         # Таблица
         table_frame = tk.Frame(root)
         table_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
 
-        self.columns = ["Дата", "Заказ", "Сумма", "Поставщик", "Плательщик", "Инициатор", "Обоснование", "Оплата", "Забрал", "Комментарии"]
+        self.columns = list(COLUMNS)
         self.tree = ttk.Treeview(table_frame, columns=self.columns, show='headings')
 
         for col in self.columns:
             self.tree.heading(col, text=col, command=lambda c=col: self.sort_column(c))
             self.tree.column(col, width=100, anchor='center')
 
-        v_scroll = ttk.Scrollbar(table_frame, orient="vertical", command=self.tree.yview)
+        v_scroll = ttk.Scrollbar(table_frame, orient="vertical")
         h_scroll = ttk.Scrollbar(table_frame, orient="horizontal", command=self.tree.xview)
-        self.tree.configure(yscroll=v_scroll.set, xscroll=h_scroll.set)
+        self.tree.configure(xscroll=h_scroll.set)
+        table_progress = ttk.Progressbar(table_frame, orient="horizontal", mode="determinate", maximum=100)
+        self.table = TableView(self.tree, v_scroll, table_progress)
 
         self.tree.grid(row=0, column=0, sticky='nsew')
         v_scroll.grid(row=0, column=1, sticky='ns')
         h_scroll.grid(row=1, column=0, sticky='ew')
+        table_progress.grid(row=2, column=0, columnspan=2, sticky='ew', pady=(2, 0))
+        table_progress.grid_remove()
 
         table_frame.grid_rowconfigure(0, weight=1)
         table_frame.grid_columnconfigure(0, weight=1)
@@ -319,6 +2415,7 @@ class RegistrumApp:
         self.context_menu.add_command(label="Удалить", command=self.delete_selected)
         self.tree.bind("<Button-3>", self.show_context_menu)
         self.tree.bind("<Double-1>", self.on_double_click)
+        self.tree.bind("<Shift-Button-1>", self.on_shift_click)
 
         if self.readonly_mode:
             self.context_menu.delete(0)
@@ -411,13 +2508,35 @@ class RegistrumApp:
                 elif isinstance(widget, ttk.Combobox):
                     widget.config(state='disabled')
 
-        self.editing_index = None
+        self.editing_id = None  # id редактируемой записи
         self.all_data = []
-        self.filtered_data = []  # данные после применения фильтров
+        self.positions = {}  # id записи -> позиция в all_data
+        self.search_index = SearchIndex()
+        self.search_index_storage = None  # хранилище, по данным которого построен индекс
+        self.search_index_job = None
+        self.date_index = DateIndex()
+        self.date_index_storage = None  # хранилище, по данным которого построен индекс дат
+        self.filtered_data = array('q')  # позиции в all_data записей, прошедших фильтры
+        self.data_version = 0  # увеличивается при каждом изменении состава или порядка all_data
+        self.filter_job = None  # отложенный запуск фильтров при наборе текста
+        self.last_filter = None  # (строка поиска, период, data_version) последнего применения фильтров
+        self.sort_keys = []  # [(колонка, по убыванию)] — сортировка отображения, первая колонка главная
+        self.sort_key_cache = {}  # колонка -> ключи сортировки, выровненные с all_data
+        self.view_rows = array('q')  # filtered_data в порядке отображения
+        self.chart_panel = None  # окно графиков, создаётся при первом открытии
+        self.column_store = ColumnStore()  # колоночные массивы all_data для итогов и графиков
+        self.cube = AggregateCube(self.column_store)  # итоги по всей базе
+        self.view_cube_cache = None  # (last_filter, куб отобранных записей); last_filter включает data_version
+        self.filtered_total = 0  # итог по записям, прошедшим фильтры, в копейках
         self.load_table()
         self.clear_form()
         self.root.protocol("WM_DELETE_WINDOW", self.on_exit)
-        self.update_yearly_total()
+        self.root.after(EXTERNAL_CHECK_MS, self.check_external_changes)
+        if PREWARM_BACKENDS:
+            self.root.after(PREWARM_DELAY_MS, self.start_prewarm)
+
+    def start_prewarm(self):
+        threading.Thread(target=prewarm_backends, name="prewarm", daemon=True).start()
 
     def can_write_to_base_dir(self) -> bool:
         if not self.base_dir:
@@ -452,8 +2571,7 @@ class RegistrumApp:
         if should_backup:
             self.create_backup(silent=True)
             try:
-                with open(backup_marker, 'w') as f:
-                    f.write(now.isoformat())
+                atomic_write(backup_marker, now.isoformat().encode('utf-8'))
             except Exception:
                 pass
 
@@ -462,16 +2580,15 @@ class RegistrumApp:
             if not silent:
                 messagebox.showwarning("Доступ запрещён", "Режим только для чтения.")
             return
-        if not self.base_path.exists():
+        if not self.storage.path.exists():
             if not silent:
                 messagebox.showwarning("Предупреждение", "Файл базы не существует!")
             return
 
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        backup_base_path = self.base_dir / f"base_{timestamp}.json"
         backup_solutor_path = self.base_dir / f"solutor_{timestamp}.json"
         try:
-            shutil.copy2(self.base_path, backup_base_path)
+            backup_base_path = self.storage.backup(timestamp)
             if self.solutor_path.exists():
                 shutil.copy2(self.solutor_path, backup_solutor_path)
             log_action(f"Созданы резервные копии: {backup_base_path.name}, {backup_solutor_path.name}")
@@ -482,78 +2599,266 @@ class RegistrumApp:
                 messagebox.showerror("Ошибка", f"Не удалось создать резервные копии:\n{e}")
 
     def load_data(self):
-        if not self.base_path.exists():
-            return []
         try:
-            with open(self.base_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return self.storage.load()
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось загрузить базу:\n{e}")
             return []
 
-    def save_data(self, data):
+    def _persist(self, operation, *args):
+        """Выполняет операцию хранилища (insert/update/delete/save_all) с обработкой ошибок."""
         if self.readonly_mode:
-            return
+            return False
         try:
-            with open(self.base_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
+            operation(*args)
+            return True
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось сохранить базу:\n{e}")
+            return False
 
     def load_table(self):
         self.all_data = self.load_data()
-        self.sort_by_date_desc()
+        self.sort_key_cache = {}
+        if not self.storage.from_cache:
+            self.sort_by_date_desc()
+        self.storage.refresh_cache(self.all_data)
+        self.rebuild_positions()
+        self.update_yearly_total()
+        if self.date_index_storage is not self.storage:
+            self.date_index = DateIndex(self.all_data)
+            self.date_index_storage = self.storage
+        if self.search_index_storage is not self.storage or self.search_index.needs_rebuild():
+            self.start_search_index_build()
         self.apply_filters()
         self.auto_adjust_column_widths()
 
+    def reload_from_disk(self):
+        """Перечитывает базу, изменённую извне, и заново строит индексы."""
+        self.date_index_storage = None
+        self.search_index_storage = None
+        self.load_table()
+
+    def check_external_changes(self):
+        try:
+            if self.storage.changed_externally():
+                log_action("База изменена другим экземпляром программы, данные перечитаны")
+                self.reload_from_disk()
+        except Exception:
+            pass
+        self.root.after(EXTERNAL_CHECK_MS, self.check_external_changes)
+
+    def rebuild_positions(self):
+        """Перестраивает индекс id записи -> позиция в all_data (после загрузки и сортировки)."""
+        self.positions = {record.id: position for position, record in enumerate(self.all_data)}
+        self.data_version += 1
+
+    def record_by_id(self, record_id):
+        position = self.positions.get(record_id)
+        return None if position is None else self.all_data[position]
+
+    def start_search_index_build(self):
+        """Строит индекс поиска порциями через цикл событий Tk, не блокируя окно.
+
+        Пока индекс не готов, поиск выполняется полным просмотром записей."""
+        if self.search_index_job is not None:
+            self.root.after_cancel(self.search_index_job)
+        self.search_index = SearchIndex()
+        self.search_index_storage = self.storage
+        self._build_search_index_step(list(self.all_data), 0)
+
+    def rebuild_search_index_if_stale(self):
+        """Перестраивает индекс поиска, если в нём накопилось много устаревших документов (правки, удаления)."""
+        if self.search_index.needs_rebuild():
+            self.start_search_index_build()
+
+    def _build_search_index_step(self, records, start):
+        index = self.search_index
+        deadline = time.perf_counter() + SEARCH_INDEX_SLICE_SECONDS
+        i = start
+        while i < len(records):
+            record = records[i]
+            i += 1
+            # Запись, уже изменённая или удалённая после начала построения, не индексируется повторно
+            if record.id not in index.doc_of and record.id in self.positions:
+                index.add(record)
+            if i % 256 == 0 and time.perf_counter() > deadline:
+                self.search_index_job = self.root.after(1, self._build_search_index_step, records, i)
+                return
+        index.ready = True
+        self.search_index_job = None
+
     def sort_by_date_desc(self):
-        def _sort_key(record):
-            date_str = record.get("Дата", "")
-            if re.fullmatch(r'\d{2}\.\d{2}\.\d{4}', str(date_str)):
-                try:
-                    d = datetime.strptime(date_str, "%d.%m.%Y")
-                    return (d.year, d.month, d.day)
-                except:
-                    pass
-            return (0, 0, 0)
-        self.all_data.sort(key=_sort_key, reverse=True)
+        self.all_data.sort(key=attrgetter("date_ord"), reverse=True)
+
+    def matches_filters(self, record) -> bool:
+        """Проходит ли запись последние применённые фильтры."""
+        if self.last_filter is None:
+            return True
+        search_term, date_from, date_to, _ = self.last_filter
+        if search_term and not any(search_term in value.lower() for value in record.values):
+            return False
+        if date_from or date_to:
+            from_ord = parse_date(date_from)[0] if date_from else None
+            to_ord = parse_date(date_to)[0] if date_to else None
+            if not record.date_ord or from_ord == 0 or to_ord == 0:
+                return False
+            if from_ord is not None and record.date_ord < from_ord:
+                return False
+            if to_ord is not None and record.date_ord > to_ord:
+                return False
+        return True
+
+    def _shift_filtered(self, start: int, delta: int):
+        """Сдвигает позиции filtered_data начиная с индекса start после вставки или удаления в all_data."""
+        filtered = self.filtered_data
+        filtered[start:] = array('q', [position + delta for position in filtered[start:]])
+
+    def model_insert(self, record):
+        """Ставит новую запись в all_data на её место по дате и, если она проходит фильтры, в filtered_data."""
+        data = self.all_data
+        # all_data отсортирован по убыванию даты: место — после всех записей с той же или более поздней датой
+        # (двоичный поиск вручную: bisect с key= есть только с Python 3.10)
+        date_ord = record.date_ord
+        position, hi = 0, len(data)
+        while position < hi:
+            mid = (position + hi) // 2
+            if data[mid].date_ord < date_ord:
+                hi = mid
+            else:
+                position = mid + 1
+        data.insert(position, record)
+        for col, keys in self.sort_key_cache.items():
+            keys.insert(position, sort_key(record, col))
+        i = bisect.bisect_left(self.filtered_data, position)
+        self._shift_filtered(i, 1)
+        if self.matches_filters(record):
+            self.filtered_data.insert(i, position)
+            self.filtered_total += record.amount
+        self.search_index.add(record)
+        self.date_index.add(record)
+        self.column_store.insert(position, record)
+
+    def model_remove(self, position: int):
+        """Убирает запись из all_data, filtered_data и индексов."""
+        record = self.all_data.pop(position)
+        for keys in self.sort_key_cache.values():
+            del keys[position]
+        filtered = self.filtered_data
+        i = bisect.bisect_left(filtered, position)
+        if i < len(filtered) and filtered[i] == position:
+            del filtered[i]
+            self.filtered_total -= record.amount
+        self._shift_filtered(i, -1)
+        self.search_index.remove(record.id)
+        self.date_index.remove(record.id)
+        self.column_store.delete(position)
+        return record
+
+    def model_update(self, position: int, record):
+        """Заменяет запись; при изменении даты запись переезжает на новое место."""
+        old = self.all_data[position]
+        if old.date_ord != record.date_ord:
+            self.model_remove(position)
+            self.model_insert(record)
+            return
+        self.all_data[position] = record
+        for col, keys in self.sort_key_cache.items():
+            keys[position] = sort_key(record, col)
+        filtered = self.filtered_data
+        i = bisect.bisect_left(filtered, position)
+        shown = i < len(filtered) and filtered[i] == position
+        matches = self.matches_filters(record)
+        if shown:
+            self.filtered_total -= old.amount
+            if not matches:
+                del filtered[i]
+        elif matches:
+            filtered.insert(i, position)
+        if matches:
+            self.filtered_total += record.amount
+        self.search_index.add(record)
+        self.date_index.add(record)
+        self.column_store.update(position, record)
+
+    def import_into_model(self, records):
+        """Добавляет много записей сразу: слияние сортировкой вместо вставки по одной."""
+        self.all_data.extend(records)
+        self.sort_by_date_desc()
+        self.sort_key_cache = {}
+        for record in records:
+            self.search_index.add(record)
+            self.date_index.add(record)
+        self.rebuild_positions()
+        self.update_yearly_total()
+        self.rebuild_search_index_if_stale()
+        self.apply_filters()
+
+    def model_changed(self):
+        """Завершает изменение модели в памяти: позиции, таблица и итоги обновляются без перечитывания базы."""
+        self.rebuild_positions()
+        self.rebuild_search_index_if_stale()
+        if self.last_filter is not None:
+            self.last_filter = self.last_filter[:3] + (self.data_version,)
+        self.view_rows = self.sorted_view()
+        self.table.show(self.all_data, self.view_rows, keep_position=True)
+        self.show_totals()
+        if self.chart_panel is not None:
+            self.chart_panel.schedule_redraw()
 
     def apply_filters(self):
         """Применяет поиск и фильтр по дате."""
+        if self.filter_job is not None:
+            self.root.after_cancel(self.filter_job)
+            self.filter_job = None
         search_term = self.search_var.get().lower()
         date_from = self.date_from_var.get().strip()
         date_to = self.date_to_var.get().strip()
+        previous = self.last_filter
+        self.last_filter = (search_term, date_from, date_to, self.data_version)
+
+        # Границы периода разбираются один раз; некорректная граница не пропускает ни одной записи
+        from_ord = parse_date(date_from)[0] if date_from else None
+        to_ord = parse_date(date_to)[0] if date_to else None
+        use_period = bool(date_from or date_to)
+        if from_ord == 0 or to_ord == 0:
+            self.filtered_data = array('q')
+            self.filtered_total = 0
+            self.refresh_table_view()
+            return
 
-        filtered = []
-        for record in self.all_data:
-            # Поиск
-            if search_term:
-                match = any(search_term in str(record.get(col, "")).lower() for col in self.columns)
-                if not match:
-                    continue
-
-            # Фильтр по дате
-            date_str = record.get("Дата", "").strip()
-            if date_from or date_to:
-                if not validate_date(date_str):
-                    continue
-                record_date = datetime.strptime(date_str, "%d.%m.%Y")
-                if date_from:
-                    if not validate_date(date_from):
-                        continue
-                    from_date = datetime.strptime(date_from, "%d.%m.%Y")
-                    if record_date < from_date:
-                        continue
-                if date_to:
-                    if not validate_date(date_to):
-                        continue
-                    to_date = datetime.strptime(date_to, "%d.%m.%Y")
-                    if record_date > to_date:
-                        continue
+        # Строка поиска дополнена при том же периоде и тех же данных — сужаем предыдущий результат;
+        # иначе период отбирается индексом дат, строка поиска — индексом поиска (пересечение множеств),
+        # а пока индекс поиска не готов — просмотром записей периода
+        all_data = self.all_data
+        check_term = bool(search_term)
+        narrowing = (previous is not None and previous[0] in search_term
+                     and previous[1:] == self.last_filter[1:])
+        if narrowing and (len(self.filtered_data) <= NARROWING_MAX_ROWS or not self.search_index.ready):
+            source = ((position, all_data[position]) for position in self.filtered_data)
+        else:
+            candidates = self.date_index.range(from_ord, to_ord) if use_period else None
+            found = self.search_index.search(search_term) if search_term else None
+            if found is not None:
+                check_term = False
+                candidates = found if candidates is None else found.intersection(candidates)
+            if candidates is None:
+                source = enumerate(all_data)
+            else:
+                positions = self.positions
+                found = sorted(positions[record_id] for record_id in candidates if record_id in positions)
+                source = ((position, all_data[position]) for position in found)
 
-            filtered.append(record)
+        filtered = array('q')
+        if not check_term:
+            filtered.extend(position for position, _ in source)
+        else:
+            for position, record in source:
+                if any(search_term in value.lower() for value in record.values):
+                    filtered.append(position)
 
         self.filtered_data = filtered
+        # Сумма отобранных записей в копейках
+        self.filtered_total = int(self.column_store.amount[np.array(filtered, dtype=np.int64)].sum())
         self.refresh_table_view()
 
     def apply_date_filter(self):
@@ -566,17 +2871,22 @@ class RegistrumApp:
         self.apply_filters()
 
     def on_search_change(self, *args):
-        self.apply_filters()
+        # Быстрый набор текста схлопывается в один запуск фильтров
+        if self.filter_job is not None:
+            self.root.after_cancel(self.filter_job)
+        self.filter_job = self.root.after(FILTER_DEBOUNCE_MS, self.apply_filters)
 
     def refresh_table_view(self):
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        self.view_rows = self.sorted_view()
+        self.table.show(self.all_data, self.view_rows)
+        self.show_totals()
+        if self.chart_panel is not None:
+            self.chart_panel.schedule_redraw()
 
-        for record in self.filtered_data:
-            values = [record.get(col, "") for col in self.columns]
-            self.tree.insert('', tk.END, values=values)
-
-        self.update_yearly_total()
+    def filtered_records(self) -> list:
+        """Записи, прошедшие фильтры, в порядке отображения."""
+        all_data = self.all_data
+        return [all_data[position] for position in self.view_rows]
 
     def auto_adjust_column_widths(self):
         default_widths = {
@@ -597,7 +2907,7 @@ class RegistrumApp:
     def clear_form(self):
         if self.readonly_mode:
             return
-        self.editing_index = None
+        self.editing_id = None
         for field in ["Дата", "Заказ", "Сумма", "Поставщик", "Инициатор", "Оплата", "Забрал"]:
             self.entries[field].delete(0, tk.END)
             if field == "Дата":
@@ -614,22 +2924,13 @@ class RegistrumApp:
         return datetime.now().strftime("%d.%m.%Y")
 
     def on_double_click(self, event):
-        selected = self.tree.selection()
+        selected = self.table.selected_ids()
         if not selected:
             return
-        item = selected[0]
-        # Найти индекс в filtered_data
-        index_in_filtered = self.tree.index(item)
-        if index_in_filtered >= len(self.filtered_data):
-            return
-        record = self.filtered_data[index_in_filtered]
-
-        # Найти оригинальный индекс в all_data
-        try:
-            self.editing_index = self.all_data.index(record)
-        except ValueError:
-            self.editing_index = None
+        record = self.record_by_id(selected[0])
+        if record is None:
             return
+        self.editing_id = record.id
 
         for field in ["Дата", "Заказ", "Сумма", "Поставщик", "Инициатор", "Оплата", "Забрал"]:
             self.entries[field].delete(0, tk.END)
@@ -670,168 +2971,133 @@ class RegistrumApp:
         record["Плательщик"] = self.payer_combobox.get().strip()
         for field in ["Обоснование", "Комментарии"]:
             record[field] = self.entries[field].get("1.0", tk.END).strip()
+        position = self.positions.get(self.editing_id)
+        if position is not None:
+            record["id"] = self.editing_id
+        record = Record(record)
 
-        data = self.all_data
-        if self.editing_index is not None and 0 <= self.editing_index < len(data):
-            old_record = data[self.editing_index]
-            data[self.editing_index] = record
-            self.save_data(data)
+        if position is not None:
+            if not self._persist(self.storage.update, record):
+                return
             log_action(f"Обновлена запись: {record.get('Заказ', 'без номера')}")
-            self.load_table()
+            if self.storage.changed_externally():
+                self.reload_from_disk()
+            else:
+                self.model_update(position, record)
+                self.model_changed()
             messagebox.showinfo("Успех", "Запись успешно обновлена!")
         else:
-            data.append(record)
-            self.save_data(data)
+            if not self._persist(self.storage.insert, [record]):
+                return
             log_action(f"Добавлена запись: {record.get('Заказ', 'без номера')} на {record.get('Сумма', '0')} руб.")
-            self.load_table()
+            if self.storage.changed_externally():
+                self.reload_from_disk()
+            else:
+                self.model_insert(record)
+                self.model_changed()
             messagebox.showinfo("Успех", "Новый заказ успешно добавлен!")
 
         self.clear_form()
 
-    def export_to_pdf(self):
-        data = self.filtered_data
-        if not data:
+    def ask_export_path(self, kind: str, extension: str):
+        """Записи для выгрузки (снимок отображаемых) и путь файла; None, если выгружать нечего или отменено."""
+        records = self.filtered_records()
+        if not records:
             messagebox.showwarning("Предупреждение", "Нет данных для экспорта!")
-            return
-
+            return None
         file_path = filedialog.asksaveasfilename(
-            title="Сохранить как PDF",
-            defaultextension=".pdf",
-            filetypes=[("PDF files", "*.pdf")]
+            title=f"Сохранить как {kind}",
+            defaultextension=extension,
+            filetypes=[(f"{kind} files", f"*{extension}")]
         )
         if not file_path:
-            return
+            return None
+        return records, file_path
 
-        try:
-            doc = SimpleDocTemplate(file_path, pagesize=landscape(A4), leftMargin=36, rightMargin=36, topMargin=36, bottomMargin=36)
-            elements = []
-
-            styles = getSampleStyleSheet()
-            title_style = styles['Title'].clone('CustomTitle')
-            if USE_CHAKRA_FONT:
-                title_style.fontName = 'ChakraPetch'
-            title_style.fontSize = 16
-            title = Paragraph("Реестр счетов покупок (Registrum)", title_style)
-            elements.append(title)
-            elements.append(Spacer(1, 12))
-
-            # Подсчёт итога
-            total_sum = 0.0
-            for record in data:
-                try:
-                    s = record.get("Сумма", "0").replace(" ", "").replace(",", ".")
-                    total_sum += float(s)
-                except:
-                    pass
-            total_paragraph = Paragraph(f"<b>Итого: {int(total_sum):,} руб.</b>".replace(',', ' '), styles['Normal'])
-            elements.append(total_paragraph)
-            elements.append(Spacer(1, 12))
-
-            # Таблица
-            table_data = [self.columns]
-            for record in data:
-                row = [str(record.get(col, "")) for col in self.columns]
-                table_data.append(row)
-
-            total_width = landscape(A4)[0] - 72
-            col_widths = []
-            for col in self.columns:
-                if col == "Обоснование":
-                    col_widths.append(total_width * 0.30)
-                elif col in ("Комментарии", "Поставщик", "Плательщик"):
-                    col_widths.append(total_width * 0.12)
-                else:
-                    col_widths.append(total_width * 0.07)
-
-            actual_sum = sum(col_widths)
-            if actual_sum > 0:
-                col_widths = [w * total_width / actual_sum for w in col_widths]
-
-            table_style = [
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'ChakraPetch' if USE_CHAKRA_FONT else 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 9),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
-                ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-                ('FONTSIZE', (0, 1), (-1, -1), 7),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ]
-            if USE_CHAKRA_FONT:
-                table_style.append(('FONTNAME', (0, 1), (-1, -1), 'ChakraPetch'))
-
-            table = Table(table_data, colWidths=col_widths, repeatRows=1)
-            table.setStyle(TableStyle(table_style))
-            elements.append(table)
-
-            # Нумерация страниц
-            def add_page_number(canvas, doc):
-                page_num = canvas.getPageNumber()
-                text = f"Стр. {page_num}"
-                canvas.setFont('Helvetica', 9)
-                canvas.drawRightString(landscape(A4)[0] - 36, 20, text)
-
-            doc.build(elements, onFirstPage=add_page_number, onLaterPages=add_page_number)
-            messagebox.showinfo("Успех", f"Файл PDF сохранён:\n{file_path}")
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось создать PDF:\n{e}")
+    def export_to_pdf(self):
+        selection = self.ask_export_path("PDF", ".pdf")
+        if selection is None:
+            return
+        records, file_path = selection
+        columns, total_line = list(self.columns), self.total_line()
+        self.export_jobs.start(ExportJob(
+            "PDF", file_path,
+            lambda path, progress: write_register_pdf(path, columns, records, total_line, progress),
+            len(records)))
 
     def export_to_excel(self):
-        data = self.filtered_data
-        if not data:
+        selection = self.ask_export_path("Excel", ".xlsx")
+        if selection is None:
+            return
+        records, file_path = selection
+        columns, cube = list(self.columns), self.view_cube()
+        total, invalid_amounts = cube.total, cube.invalid_amounts
+        self.export_jobs.start(ExportJob(
+            "Excel", file_path,
+            lambda path, progress: write_register_xlsx(path, columns, records, total, invalid_amounts, progress),
+            len(records)))
+
+    def export_to_csv(self):
+        selection = self.ask_export_path("CSV", ".csv")
+        if selection is None:
+            return
+        records, file_path = selection
+        columns = list(self.columns)
+        self.export_jobs.start(ExportJob(
+            "CSV", file_path,
+            lambda path, progress: write_register_csv(path, columns, records, progress),
+            len(records)))
+
+    def open_batch_reports(self):
+        """Пакетные отчёты: по PDF и/или Excel на каждого плательщика и/или год из отображаемых записей."""
+        records = self.filtered_records()
+        if not records:
             messagebox.showwarning("Предупреждение", "Нет данных для экспорта!")
             return
 
-        file_path = filedialog.asksaveasfilename(
-            title="Сохранить как Excel",
-            defaultextension=".xlsx",
-            filetypes=[("Excel files", "*.xlsx")]
-        )
-        if not file_path:
-            return
+        reports_win = tk.Toplevel(self.root)
+        reports_win.title("Пакетные отчёты")
+        reports_win.resizable(False, False)
+        reports_win.grab_set()
+
+        count = f"{len(records):,}".replace(',', ' ')
+        tk.Label(reports_win, text=f"Записей для отчётов (с учётом фильтров): {count}",
+                 font=("Arial", 10)).pack(anchor='w', padx=10, pady=(10, 5))
+
+        mode = tk.StringVar(value=BATCH_PARTITIONS[0][0])
+        for value, text in BATCH_PARTITIONS:
+            tk.Radiobutton(reports_win, text=text, variable=mode, value=value,
+                           font=("Arial", 10)).pack(anchor='w', padx=20)
+
+        formats_frame = tk.Frame(reports_win)
+        formats_frame.pack(anchor='w', padx=20, pady=5)
+        pdf_var = tk.BooleanVar(value=True)
+        excel_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(formats_frame, text="PDF", variable=pdf_var, font=("Arial", 10)).pack(side=tk.LEFT)
+        tk.Checkbutton(formats_frame, text="Excel", variable=excel_var, font=("Arial", 10)).pack(side=tk.LEFT, padx=10)
+
+        def run():
+            kinds = [kind for kind, var in (("PDF", pdf_var), ("Excel", excel_var)) if var.get()]
+            if not kinds:
+                messagebox.showwarning("Предупреждение", "Выберите хотя бы один формат.", parent=reports_win)
+                return
+            directory = filedialog.askdirectory(title="Папка для отчётов", parent=reports_win)
+            if not directory:
+                return
+            reports_win.destroy()
+            self.start_batch_reports(records, mode.get(), kinds, Path(directory))
 
-        try:
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Реестр счетов"
-            ws.append(self.columns)
-            for cell in ws[1]:
-                cell.font = Font(bold=True, color="FFFFFF")
-                cell.fill = PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid")
-                cell.alignment = Alignment(horizontal="center", vertical="center")
-
-            for record in data:
-                row = [record.get(col, "") for col in self.columns]
-                ws.append(row)
-
-            # Итоговая строка
-            total_sum = 0.0
-            for record in data:
-                try:
-                    s = record.get("Сумма", "0").replace(" ", "").replace(",", ".")
-                    total_sum += float(s)
-                except:
-                    pass
-            ws.append([""] * (len(self.columns) - 1) + [f"Итого: {int(total_sum):,} руб.".replace(',', ' ')])
+        tk.Button(reports_win, text="Сформировать", command=run, width=20).pack(pady=10)
 
-            for col in ws.columns:
-                max_length = 0
-                column = col[0].column_letter
-                for cell in col:
-                    cell.alignment = Alignment(wrap_text=True, vertical="top")
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 40)
-                ws.column_dimensions[column].width = adjusted_width
-
-            wb.save(file_path)
-            messagebox.showinfo("Успех", f"Файл Excel сохранён:\n{file_path}")
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось создать Excel:\n{e}")
+    def start_batch_reports(self, records, mode: str, kinds, directory: Path):
+        partitions = partition_records(records, mode)
+        columns = list(self.columns)
+        manifest_path = directory / BATCH_MANIFEST_NAME
+        self.export_jobs.start(ExportJob(
+            "отчёты", manifest_path,
+            lambda path, progress: write_batch_reports(path, directory, mode, kinds, columns, partitions, progress),
+            len(partitions), unit="частей",
+            done_text=f"Отчёты сохранены в папку:\n{directory}\nСписок файлов: {BATCH_MANIFEST_NAME}"))
 
     def import_from_csv(self):
         if self.readonly_mode:
@@ -854,18 +3120,25 @@ class RegistrumApp:
                     if not row.get("Поставщик") or not row.get("Сумма"):
                         continue
                     # Приводим к нужному формату
-                    record = {col: row.get(col, "") for col in self.columns}
+                    record = Record({col: row.get(col, "") for col in self.columns})
                     new_records.append(record)
 
             if not new_records:
                 messagebox.showwarning("Предупреждение", "Нет корректных записей для импорта.")
                 return
 
-            if messagebox.askyesno("Подтверждение", f"Будет добавлено {len(new_records)} записей. Продолжить?"):
-                self.all_data.extend(new_records)
-                self.save_data(self.all_data)
+            question = f"Будет добавлено {len(new_records)} записей."
+            invalid = sum(1 for record in new_records if not record.amount_valid)
+            if invalid:
+                question += f"\nС некорректной суммой (в итоги войдут нулём): {invalid}."
+            if messagebox.askyesno("Подтверждение", question + " Продолжить?"):
+                if not self._persist(self.storage.insert, new_records):
+                    return
                 log_action(f"Импортировано {len(new_records)} записей из CSV")
-                self.load_table()
+                if self.storage.changed_externally():
+                    self.reload_from_disk()
+                else:
+                    self.import_into_model(new_records)
                 messagebox.showinfo("Успех", "Импорт завершён успешно!")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось импортировать CSV:\n{e}")
@@ -886,7 +3159,7 @@ class RegistrumApp:
 
         settings_win = tk.Toplevel(self.root)
         settings_win.title("Настройки")
-        settings_win.geometry("600x150")
+        settings_win.geometry("600x260")
         settings_win.resizable(False, False)
         settings_win.grab_set()
 
@@ -916,8 +3189,13 @@ class RegistrumApp:
             self.base_path = new_dir_path / "base.json"
             self.solutor_path = new_dir_path / "solutor.json"
             save_base_dir(self.base_dir)
+            recover_temp_files(self.base_dir, RECOVERABLE_FILES)
             ensure_base_exists(self.base_path)
             ensure_solutor_exists(self.solutor_path)
+            self.storage.close()
+            self.storage = open_storage(self.base_dir, self.readonly_mode)
+            self.storage.ensure_exists()
+            update_storage_label()
             self.payers_manager.solutor_path = self.solutor_path
             self.payers_manager.load_payers()
             self.payer_combobox['values'] = self.payers_manager.payers
@@ -931,6 +3209,62 @@ class RegistrumApp:
 
         tk.Button(settings_win, text="Изменить путь", command=change_path, width=20).pack(pady=10)
 
+        storage_label = tk.Label(settings_win, text="", font=("Arial", 10))
+        storage_label.pack(pady=5)
+
+        def update_storage_label():
+            if self.storage.name == "sqlite":
+                storage_label.config(text=f"Хранилище: SQLite ({self.storage.path.name})")
+            else:
+                storage_label.config(text=f"Хранилище: JSON ({self.storage.path.name})")
+
+        def migrate_to_sqlite():
+            if self.storage.name == "sqlite":
+                messagebox.showinfo("Инфо", "База уже хранится в SQLite.")
+                return
+            if not messagebox.askyesno("Подтверждение", "Перенести base.json в базу SQLite (base.db)?"):
+                return
+            sqlite_storage = SqliteStorage(self.base_dir, self.readonly_mode)
+            try:
+                count = sqlite_storage.migrate_from_json(self.storage)
+            except Exception as e:
+                sqlite_storage.close()
+                messagebox.showerror("Ошибка", f"Не удалось перенести базу в SQLite:\n{e}")
+                return
+            self.storage.close()
+            self.storage = sqlite_storage
+            log_action(f"База перенесена в SQLite: {count} записей")
+            update_storage_label()
+            self.load_table()
+            messagebox.showinfo("Успех", f"Перенесено записей: {count}")
+
+        def export_to_json():
+            if self.storage.name != "sqlite":
+                messagebox.showinfo("Инфо", "База уже хранится в base.json.")
+                return
+            if not messagebox.askyesno("Подтверждение", "Выгрузить базу SQLite в base.json и вернуться к хранению в JSON?"):
+                return
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            json_storage = JsonStorage(self.base_dir, self.readonly_mode)
+            try:
+                count = self.storage.export_to_json(json_storage)
+                self.storage.close()
+                self.storage.path.rename(self.storage.path.with_name(f"base_{timestamp}.db"))
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось выгрузить базу в base.json:\n{e}")
+                return
+            self.storage = json_storage
+            log_action(f"База выгружена из SQLite в base.json: {count} записей")
+            update_storage_label()
+            self.load_table()
+            messagebox.showinfo("Успех", f"Выгружено записей: {count}")
+
+        storage_btn_frame = tk.Frame(settings_win)
+        storage_btn_frame.pack(pady=5)
+        tk.Button(storage_btn_frame, text="Перейти на SQLite", command=migrate_to_sqlite, width=20).pack(side=tk.LEFT, padx=5)
+        tk.Button(storage_btn_frame, text="Вернуться к base.json", command=export_to_json, width=20).pack(side=tk.LEFT, padx=5)
+        update_storage_label()
+
     def open_payers_window(self):
         self.payers_manager.open_payers_window()
 
@@ -945,375 +3279,134 @@ class RegistrumApp:
             messagebox.showwarning("Доступ запрещён", "Режим только для чтения.")
             return
 
-        selected = self.tree.selection()
+        selected = self.table.selected_ids()
         if not selected:
             return
         if not messagebox.askyesno("Подтверждение", "Удалить выбранную запись?"):
             return
 
-        index_in_filtered = self.tree.index(selected[0])
-        if index_in_filtered >= len(self.filtered_data):
-            return
-        record_to_delete = self.filtered_data[index_in_filtered]
-
-        try:
-            self.all_data.remove(record_to_delete)
-        except ValueError:
+        position = self.positions.get(selected[0])
+        if position is None:
             messagebox.showerror("Ошибка", "Запись не найдена в базе.")
             return
+        record_to_delete = self.all_data[position]
 
-        self.save_data(self.all_data)
+        if not self._persist(self.storage.delete, record_to_delete):
+            return
         log_action(f"Удалена запись: {record_to_delete.get('Заказ', 'без номера')}")
-        self.load_table()
+        if self.storage.changed_externally():
+            self.reload_from_disk()
+        else:
+            self.model_remove(position)
+            self.model_changed()
         self.clear_form()
         messagebox.showinfo("Успех", "Запись удалена.")
 
-    def sort_column(self, col):
-        reverse = False
-        if hasattr(self, '_last_sorted_col') and self._last_sorted_col == col:
-            reverse = not getattr(self, '_last_sorted_reverse', False)
+    def column_sort_keys(self, col) -> list:
+        """Ключи сортировки колонки для всех записей (вычисляются один раз до перезагрузки данных)."""
+        keys = self.sort_key_cache.get(col)
+        if keys is None:
+            keys = self.sort_key_cache[col] = [sort_key(record, col) for record in self.all_data]
+        return keys
+
+    def sorted_view(self):
+        """filtered_data, упорядоченные по sort_keys (без сортировки — по убыванию даты, как в all_data)."""
+        if not self.sort_keys:
+            return self.filtered_data
+        view = list(self.filtered_data)
+        # Устойчивая сортировка от младшей колонки к главной даёт сортировку по нескольким ключам
+        for col, reverse in reversed(self.sort_keys):
+            view.sort(key=self.column_sort_keys(col).__getitem__, reverse=reverse)
+        return array('q', view)
+
+    def sort_column(self, col, add=False):
+        """Щелчок по заголовку: сортировка по колонке, повторный щелчок меняет направление.
+
+        С Shift колонка добавляется к сортировке следующим ключом (или у неё меняется направление)."""
+        columns = [c for c, _ in self.sort_keys]
+        if not add and columns == [col]:
+            # Та же колонка — меняется направление. Не разворачиваем view_rows: равные строки
+            # остались бы в обратном порядке, а sorted_view после сохранения вернул бы их обратно
+            self.sort_keys = [(col, not self.sort_keys[0][1])]
+        elif not add:
+            self.sort_keys = [(col, False)]
+        elif col in columns:
+            i = columns.index(col)
+            self.sort_keys[i] = (col, not self.sort_keys[i][1])
         else:
-            reverse = False
-
-        self._last_sorted_col = col
-        self._last_sorted_reverse = reverse
-
-        def _sort_key(record):
-            val = record.get(col, "")
-            if col == "Дата":
-                if re.fullmatch(r'\d{2}\.\d{2}\.\d{4}', str(val)):
-                    try:
-                        d = datetime.strptime(val, "%d.%m.%Y")
-                        return (d.year, d.month, d.day)
-                    except:
-                        pass
-                return (9999, 99, 99)
-            else:
-                try:
-                    return float(str(val).replace(" ", "").replace(",", "."))
-                except:
-                    return str(val).lower()
-
-        self.all_data.sort(key=_sort_key, reverse=reverse)
-        self.apply_filters()
+            self.sort_keys.append((col, False))
+        self.view_rows = self.sorted_view()
+        self.update_sort_headings()
+        self.table.show(self.all_data, self.view_rows)
+
+    def on_shift_click(self, event):
+        if self.tree.identify_region(event.x, event.y) != "heading":
+            return None
+        column = self.tree.identify_column(event.x)  # "#1", "#2", ...
+        try:
+            col = self.columns[int(column[1:]) - 1]
+        except (ValueError, IndexError):
+            return None
+        self.sort_column(col, add=True)
+        return "break"
+
+    def update_sort_headings(self):
+        numbered = len(self.sort_keys) > 1
+        marks = {col: (" ▼" if reverse else " ▲") + (str(i + 1) if numbered else "")
+                 for i, (col, reverse) in enumerate(self.sort_keys)}
+        for col in self.columns:
+            self.tree.heading(col, text=col + marks.get(col, ""))
 
     def update_yearly_total(self):
-        current_year = datetime.now().year
-        total_current = 0.0
-        total_all = 0.0
-        for record in self.all_data:
-            date_str = record.get("Дата", "").strip()
-            sum_str = record.get("Сумма", "").strip()
-
-            year = None
-            if re.match(r'\d{2}\.\d{2}\.\d{4}', date_str):
-                try:
-                    year = datetime.strptime(date_str, "%d.%m.%Y").year
-                except:
-                    pass
-
-            try:
-                sum_val = float(sum_str.replace(" ", "").replace(",", "."))
-                total_all += sum_val
-                if year == current_year:
-                    total_current += sum_val
-            except:
-                pass
-
-        self.status_label.config(
-            text=f"Текущий год: {int(total_current):,} руб. | Всего: {int(total_all):,} руб.".replace(',', ' ')
-        )
+        """Строит колоночные массивы и куб итогов по всей базе (после загрузки или слияния импорта);
+        дальше их поправляют model_insert/model_remove/model_update."""
+        self.column_store = ColumnStore(self.all_data)
+        self.cube = AggregateCube(self.column_store)
+        self.view_cube_cache = None
+
+    def filters_active(self) -> bool:
+        return self.last_filter is not None and any(self.last_filter[:3])
+
+    def view_cube(self):
+        """Куб итогов по отображаемым записям: без фильтров — куб всей базы, иначе строится
+        по отобранным записям один раз на версию данных и набор фильтров."""
+        if not self.filters_active():
+            return self.cube
+        key = self.last_filter
+        if self.view_cube_cache is None or self.view_cube_cache[0] != key:
+            positions = np.array(self.filtered_data, dtype=np.int64)
+            self.view_cube_cache = (key, AggregateCube(self.column_store, positions))
+        return self.view_cube_cache[1]
+
+    def total_line(self) -> str:
+        """Строка "Итого" для экспорта отображаемых записей."""
+        cube = self.view_cube()
+        return format_total_line(cube.total, cube.invalid_amounts)
+
+    def show_totals(self):
+        total_current = self.cube.by_year.get(datetime.now().year, 0)
+        text = f"Текущий год: {format_money(total_current)} руб. | Всего: {format_money(self.cube.total)} руб."
+        if self.filters_active():
+            count = f"{len(self.filtered_data):,}".replace(',', ' ')
+            text += f" | Отобрано: {count} на {format_money(self.filtered_total)} руб."
+        if self.cube.invalid_amounts:
+            text += f" | Некорректных сумм: {self.cube.invalid_amounts}"
+        self.status_label.config(text=text)
 
     def show_chart(self):
-        data = self.filtered_data
-        if not data:
+        if not self.filtered_data:
             messagebox.showwarning("Предупреждение", "Нет данных для построения графика!")
             return
-
-        chart_win = tk.Toplevel(self.root)
-        chart_win.title("Выбор типа графика")
-        chart_win.geometry("350x270")
-        chart_win.grab_set()
-
-        tk.Label(chart_win, text="Выберите тип графика:", font=("Arial", 12, "bold")).pack(pady=(15, 10))
-
-        chart_type = tk.StringVar(value="yearly_total")
-
-        tk.Radiobutton(chart_win, text="Общий по годам", variable=chart_type, value="yearly_total", font=("Arial", 10)).pack(anchor=tk.W, padx=30, pady=2)
-        tk.Radiobutton(chart_win, text="Сравнение плательщиков по годам", variable=chart_type, value="payer_comparison", font=("Arial", 10)).pack(anchor=tk.W, padx=30, pady=2)
-        tk.Radiobutton(chart_win, text="Детализация по годам", variable=chart_type, value="yearly_detail", font=("Arial", 10)).pack(anchor=tk.W, padx=30, pady=2)
-        tk.Radiobutton(chart_win, text="По месяцам (текущий год)", variable=chart_type, value="monthly_current", font=("Arial", 10)).pack(anchor=tk.W, padx=30, pady=2)
-
-        def show_selected_chart():
-            chart_win.destroy()
-            if chart_type.get() == "yearly_total":
-                self._show_yearly_total_chart(data)
-            elif chart_type.get() == "payer_comparison":
-                self._show_payer_comparison_chart(data)
-            elif chart_type.get() == "yearly_detail":
-                self._show_yearly_detail_chart(data)
-            elif chart_type.get() == "monthly_current":
-                self._show_monthly_chart(data)
-
-        tk.Button(chart_win, text="Показать график", command=show_selected_chart, font=("Arial", 10), width=20).pack(pady=20)
-
-    def _show_yearly_total_chart(self, data):
-        yearly_totals = {}
-        for record in data:
-            date_str = record.get("Дата", "").strip()
-            sum_str = record.get("Сумма", "").strip()
-            year = None
-            if re.match(r'\d{2}\.\d{2}\.\d{4}', date_str):
-                try:
-                    year = datetime.strptime(date_str, "%d.%m.%Y").year
-                except:
-                    continue
-            try:
-                sum_val = float(sum_str.replace(" ", "").replace(",", "."))
-            except:
-                continue
-            if year not in yearly_totals:
-                yearly_totals[year] = 0.0
-            yearly_totals[year] += sum_val
-
-        if not yearly_totals:
-            messagebox.showwarning("Предупреждение", "Не удалось извлечь данные для графика!")
-            return
-
-        years = sorted(yearly_totals.keys())
-        totals = [yearly_totals[year] for year in years]
-
-        fig, ax = plt.subplots(figsize=(12, 7))
-        bars = ax.bar(years, totals, color='steelblue')
-        for bar in bars:
-            height = bar.get_height()
-            ax.annotate(f'{int(height):,}'.replace(',', ' '),
-                        xy=(bar.get_x() + bar.get_width() / 2, height),
-                        xytext=(0, 3),
-                        textcoords="offset points",
-                        ha='center', va='bottom', fontweight='bold')
-
-        ax.set_title("Общие затраты по годам", fontsize=16, fontweight='bold')
-        ax.set_xlabel("Год", fontsize=12)
-        ax.set_ylabel("Сумма (руб.)", fontsize=12)
-        ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{int(x):,}'.replace(',', ' ')))
-        ax.set_xticks(years)
-        ax.set_xticklabels([str(y) for y in years])
-        ax.grid(axis='y', linestyle='--', alpha=0.7)
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
-        ax.set_facecolor('#f8f9fa')
-
-        manager = plt.get_current_fig_manager()
-        try:
-            manager.window.state('zoomed')
-        except:
-            pass
-        plt.tight_layout()
-        plt.show()
-
-    def _show_payer_comparison_chart(self, data):
-        yearly_payer_totals = {}
-        for record in data:
-            date_str = record.get("Дата", "").strip()
-            sum_str = record.get("Сумма", "").strip()
-            payer = record.get("Плательщик", "").strip()
-            if not payer:
-                continue
-            year = None
-            if re.match(r'\d{2}\.\d{2}\.\d{4}', date_str):
-                try:
-                    year = datetime.strptime(date_str, "%d.%m.%Y").year
-                except:
-                    continue
-            try:
-                sum_val = float(sum_str.replace(" ", "").replace(",", "."))
-            except:
-                continue
-            if year not in yearly_payer_totals:
-                yearly_payer_totals[year] = {}
-            if payer not in yearly_payer_totals[year]:
-                yearly_payer_totals[year][payer] = 0.0
-            yearly_payer_totals[year][payer] += sum_val
-
-        if not yearly_payer_totals:
-            messagebox.showwarning("Предупреждение", "Не удалось извлечь данные для графика!")
-            return
-
-        years = sorted(yearly_payer_totals.keys())
-        all_payers = sorted(set(payer for year_data in yearly_payer_totals.values() for payer in year_data.keys()))
-        payer_totals_per_year = {payer: [] for payer in all_payers}
-        for year in years:
-            for payer in all_payers:
-                payer_totals_per_year[payer].append(yearly_payer_totals[year].get(payer, 0.0))
-
-        fig, ax = plt.subplots(figsize=(14, 8))
-        bottom = np.zeros(len(years))
-        colors = plt.cm.tab20(np.linspace(0, 1, len(all_payers)))
-        for i, payer in enumerate(all_payers):
-            ax.bar(years, payer_totals_per_year[payer], bottom=bottom, label=payer, color=colors[i])
-            bottom += np.array(payer_totals_per_year[payer])
-
-        for i, year in enumerate(years):
-            total = sum(payer_totals_per_year[payer][i] for payer in all_payers)
-            ax.annotate(f'{int(total):,}'.replace(',', ' '),
-                        xy=(year, total),
-                        xytext=(0, 3),
-                        textcoords="offset points",
-                        ha='center', va='bottom', fontweight='bold')
-
-        ax.set_title("Сравнение затрат по плательщикам по годам", fontsize=16, fontweight='bold')
-        ax.set_xlabel("Год", fontsize=12)
-        ax.set_ylabel("Сумма (руб.)", fontsize=12)
-        ax.legend(title="Плательщики", bbox_to_anchor=(1.05, 1), loc='upper left')
-        ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{int(x):,}'.replace(',', ' ')))
-        ax.set_xticks(years)
-        ax.set_xticklabels([str(y) for y in years])
-        ax.grid(axis='y', linestyle='--', alpha=0.7)
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
-        ax.set_facecolor('#f8f9fa')
-
-        manager = plt.get_current_fig_manager()
-        try:
-            manager.window.state('zoomed')
-        except:
-            pass
-        plt.tight_layout()
-        plt.show()
-
-    def _show_yearly_detail_chart(self, data):
-        yearly_payer_totals = {}
-        for record in data:
-            date_str = record.get("Дата", "").strip()
-            sum_str = record.get("Сумма", "").strip()
-            payer = record.get("Плательщик", "").strip()
-            if not payer:
-                continue
-            year = None
-            if re.match(r'\d{2}\.\d{2}\.\d{4}', date_str):
-                try:
-                    year = datetime.strptime(date_str, "%d.%m.%Y").year
-                except:
-                    continue
-            try:
-                sum_val = float(sum_str.replace(" ", "").replace(",", "."))
-            except:
-                continue
-            if year not in yearly_payer_totals:
-                yearly_payer_totals[year] = {}
-            if payer not in yearly_payer_totals[year]:
-                yearly_payer_totals[year][payer] = 0.0
-            yearly_payer_totals[year][payer] += sum_val
-
-        if not yearly_payer_totals:
-            messagebox.showwarning("Предупреждение", "Не удалось извлечь данные для графика!")
-            return
-
-        years = sorted(yearly_payer_totals.keys())
-        n_years = len(years)
-        cols = 2
-        rows = (n_years + 1) // cols
-        fig, axes = plt.subplots(rows, cols, figsize=(16, 6 * rows))
-        if n_years == 1:
-            axes = [axes]
-        elif rows == 1:
-            axes = axes if isinstance(axes, np.ndarray) else [axes]
-        else:
-            axes = axes.flatten()
-
-        all_payers = sorted(set(payer for year_data in yearly_payer_totals.values() for payer in year_data.keys()))
-        colors = plt.cm.tab20(np.linspace(0, 1, len(all_payers)))
-        payer_colors = {payer: colors[i] for i, payer in enumerate(all_payers)}
-
-        for i, year in enumerate(years):
-            ax = axes[i] if n_years > 1 else axes[0]
-            year_data = yearly_payer_totals[year]
-            sorted_payers = sorted(year_data.items(), key=lambda x: x[1], reverse=True)
-            payers = [item[0] for item in sorted_payers]
-            amounts = [item[1] for item in sorted_payers]
-            year_colors = [payer_colors[payer] for payer in payers]
-            bars = ax.bar(payers, amounts, color=year_colors)
-            for bar in bars:
-                height = bar.get_height()
-                ax.annotate(f'{int(height):,}'.replace(',', ' '),
-                            xy=(bar.get_x() + bar.get_width() / 2, height),
-                            xytext=(0, 3),
-                            textcoords="offset points",
-                            ha='center', va='bottom', fontweight='bold')
-            ax.set_title(f"Затраты по плательщикам за {year} год", fontsize=14, fontweight='bold')
-            ax.set_ylabel("Сумма (руб.)", fontsize=12)
-            ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{int(x):,}'.replace(',', ' ')))
-            ax.tick_params(axis='x', rotation=45)
-            ax.grid(axis='y', linestyle='--', alpha=0.7)
-            ax.spines['top'].set_visible(False)
-            ax.spines['right'].set_visible(False)
-            ax.set_facecolor('#f8f9fa')
-
-        for j in range(n_years, len(axes)):
-            if n_years > 1:
-                axes[j].set_visible(False)
-
-        manager = plt.get_current_fig_manager()
-        try:
-            manager.window.state('zoomed')
-        except:
-            pass
-        plt.tight_layout()
-        plt.show()
-
-    def _show_monthly_chart(self, data):
-        """График по месяцам за текущий год."""
-        current_year = datetime.now().year
-        monthly_totals = {i: 0.0 for i in range(1, 13)}
-
-        for record in data:
-            date_str = record.get("Дата", "").strip()
-            sum_str = record.get("Сумма", "").strip()
-            if not re.match(r'\d{2}\.\d{2}\.\d{4}', date_str):
-                continue
-            try:
-                dt = datetime.strptime(date_str, "%d.%m.%Y")
-                if dt.year != current_year:
-                    continue
-                sum_val = float(sum_str.replace(" ", "").replace(",", "."))
-                monthly_totals[dt.month] += sum_val
-            except:
-                continue
-
-        months = ["Янв", "Фев", "Мар", "Апр", "Май", "Июн",
-                  "Июл", "Авг", "Сен", "Окт", "Ноя", "Дек"]
-        totals = [monthly_totals[i] for i in range(1, 13)]
-
-        fig, ax = plt.subplots(figsize=(14, 7))
-        bars = ax.bar(months, totals, color='teal')
-        for bar in bars:
-            height = bar.get_height()
-            if height > 0:
-                ax.annotate(f'{int(height):,}'.replace(',', ' '),
-                            xy=(bar.get_x() + bar.get_width() / 2, height),
-                            xytext=(0, 3),
-                            textcoords="offset points",
-                            ha='center', va='bottom', fontweight='bold')
-
-        ax.set_title(f"Затраты по месяцам за {current_year} год", fontsize=16, fontweight='bold')
-        ax.set_xlabel("Месяц", fontsize=12)
-        ax.set_ylabel("Сумма (руб.)", fontsize=12)
-        ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{int(x):,}'.replace(',', ' ')))
-        ax.grid(axis='y', linestyle='--', alpha=0.7)
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
-        ax.set_facecolor('#f8f9fa')
-
-        manager = plt.get_current_fig_manager()
-        try:
-            manager.window.state('zoomed')
-        except:
-            pass
-        plt.tight_layout()
-        plt.show()
+        if self.chart_panel is None:
+            self.chart_panel = ChartPanel(self.root, self.view_cube)
+        self.chart_panel.show()
 
     def on_exit(self):
+        if self.export_jobs.running():
+            if not messagebox.askyesno("Выход", "Идёт выгрузка файлов. Прервать её и выйти?"):
+                return
+            self.export_jobs.cancel_all()
+        self.storage.close()
         self.root.destroy()
 
 
@@ -1324,4 +3417,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # для пакетных отчётов в собранном exe под Windows
     main()
\ No newline at end of file